@@ -33,10 +33,14 @@ from etcd import EtcdError
 
 from .cache import make_client as make_cache_client
 from xscheduler import store
-from xscheduler.release import ReleaseStore, Release
+from xscheduler.release import (ReleaseStore, Release, ReleaseError,
+                                check_services)
+from xscheduler import migration
+from xscheduler.scheduler import (PlacementError, check_placement,
+                                  check_resources)
 
 
-def _collection(request, items, url, build, **links):
+def _collection(request, items, url, build, build_many=None, **links):
     """Convenience function for handing a collection request (aka
     'index').
 
@@ -49,7 +53,11 @@ def _collection(request, items, url, build, **links):
         parameters to the URL.
     @param build: a callable that takes a single parameter, the item,
         and returns a python C{dict} that is the item representation.
-        
+    @param build_many: optional callable that takes the list of items
+        on the page and returns their representations.  Used instead
+        of C{build} when given, to fetch data for the whole page at
+        once.
+
     @param links: Additional links for the representation.
     """
     offset = int(request.params.get('offset', 0))
@@ -63,8 +71,11 @@ def _collection(request, items, url, build, **links):
         links['next'] = url(offset=offset + page_size,
                             page_size=page_size)
 
-    return Response(json={'items': [build(item) for item in items],
-                          'links': links}, status=200)
+    if build_many is None:
+        built = [build(item) for item in items]
+    else:
+        built = build_many(items)
+    return Response(json={'items': built, 'links': links}, status=200)
 
 
 class _BaseResource(object):
@@ -165,11 +176,13 @@ class FormationResource(_BaseResource):
 class ReleaseResource(_BaseResource):
     """The app resource."""
 
-    def __init__(self, log, url, curl, store, factory):
+    def __init__(self, log, url, curl, murl, store, migrations, factory):
         self.log = log
         self.url = url
         self.curl = curl
+        self.murl = murl
         self.store = store
+        self.migrations = migrations
         self.factory = factory
 
     def index(self, request, formation):
@@ -190,6 +203,17 @@ class ReleaseResource(_BaseResource):
 
     def create(self, request, formation):
         data = self._assert_request_content(request, 'name', 'services')
+        try:
+            check_services(data['services'])
+            self.factory(formation, data['name'],
+                         data['services']).dependency_levels()
+        except ReleaseError, err:
+            raise HTTPBadRequest(str(err))
+        try:
+            for service in data['services'].itervalues():
+                check_resources(service.get('resources'))
+        except PlacementError, err:
+            raise HTTPBadRequest(str(err))
         self.store.create(formation, data['name'], data)
         response = Response(json=self._build(data), status=201)
         response.headers.add('Location', self.url(formation=formation,
@@ -207,17 +231,62 @@ class ReleaseResource(_BaseResource):
         data = self.store.get(formation, name)
         self._check_not_found(data)
         release = self.factory(formation, name, data['services'])
-        more = release.scale(params['scales'])
+        more = release.scale(params['scales'],
+                             self._int_param(params, 'limit', None))
         return Response(json=more or False, status=200)
 
+    def _build_migration(self, formation, name, data):
+        data = data.copy()
+        data.update({'kind': 'gilliam#migration', 'formation': formation,
+                     'release': name})
+        return data
+
+    def _int_param(self, params, name, default):
+        value = params.get(name, default)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise HTTPBadRequest()
+        if value < 1:
+            raise HTTPBadRequest()
+        return value
+
     def migrate(self, request, formation, name):
+        """Start migrating instances to the release.
+
+        The migration is done in the background by the leader.  If a
+        migration to the release is already in progress it is
+        returned instead of a new one being started.
+        """
         params = self._assert_request_content(request)
         data = self.store.get(formation, name)
         self._check_not_found(data)
-        release = self.factory(formation, name, data['services'])
-        more = release.migrate(params.get('from'))
-        print "MIGRATE RESULT", more
-        return Response(json=more or False, status=200)
+        current = self.migrations.get(formation, name)
+        if (current is not None
+                and current.get('state') in migration.ACTIVE_STATES):
+            status, data = 200, current
+        else:
+            status, data = 202, migration.new_migration(
+                params.get('from'),
+                self._int_param(params, 'batch_size', 10),
+                self._int_param(params, 'max_unavailable', None))
+            self.migrations.set(formation, name, data)
+        response = Response(json=self._build_migration(formation, name, data),
+                            status=status)
+        response.headers.add('Location', self.murl(formation=formation,
+                                                   name=name))
+        return response
+
+    def migration(self, request, formation, name):
+        """Return the progress of the latest migration to the
+        release.
+        """
+        data = self.migrations.get(formation, name)
+        self._check_not_found(data)
+        return Response(json=self._build_migration(formation, name, data),
+                        status=200)
 
 
 class InstanceResource(_BaseResource):
@@ -233,10 +302,11 @@ class InstanceResource(_BaseResource):
 
     # we need a specific build function here since we need to
     # fetch the release.
-    def _build(self, data):
-        status = self.state_cache.get(data.formation,
-                                      data.service,
-                                      data.instance)
+    def _build(self, data, status=None):
+        if status is None:
+            status = self.state_cache.get(data.formation,
+                                          data.service,
+                                          data.instance)
         data = data.to_json()
         data.update({
                 'kind': 'gilliam#instance',
@@ -245,20 +315,33 @@ class InstanceResource(_BaseResource):
                 })
         return data
 
+    def _build_many(self, insts):
+        statuses = self.state_cache.get_many(
+            [(inst.formation, inst.service, inst.instance)
+             for inst in insts])
+        return [self._build(inst, status)
+                for (inst, status) in zip(insts, statuses)]
+
     def index(self, request, formation):
         return _collection(request, self.store.query_formation(formation),
                            partial(self.curl, formation=formation),
-                           self._build)
+                           self._build, self._build_many)
 
     def create(self, request, formation):
         data = self._assert_request_content(request, 'service', 
                                             'release', 'image',
                                             'command')
+        try:
+            check_placement(data.get('placement'))
+            check_resources(data.get('resources'))
+        except PlacementError, err:
+            raise HTTPBadRequest(str(err))
         inst = store.create(self.command, formation, data['service'],
                             data['release'], data['image'], data['command'],
                             data.get('env'), data.get('ports'),
                             data.get('assigned_to'),
-                            data.get('placement'))
+                            data.get('placement'),
+                            data.get('resources'))
         return Response(status=201, json=self._build(inst))
 
     def show(self, request, formation, service, instance):
@@ -299,6 +382,9 @@ class API(object):
         release_collection.member.link(
             'migrate', 'migrate_release', action='migrate',
             method='POST', formatted=False)
+        release_collection.member.link(
+            'migration', 'migration_release', action='migration',
+            method='GET', formatted=False)
 
         instance_collection = self.mapper.collection(
             "instances", "instance",
@@ -351,7 +437,8 @@ def main():
     registry_client = ServiceRegistryClient(time)
     registry_resolver = Resolver(registry_client)
     state_cache = make_cache_client(registry_resolver,
-                                    '_cache.{0}.service'.format(formation))
+                                    '_cache.{0}.service'.format(formation),
+                                    mirror=True)
     
     api = API(logging.getLogger('api'), {})
 
@@ -366,7 +453,9 @@ def main():
             logging.getLogger('api.release'),
             partial(api.url, 'release'),
             partial(api.url, 'releases'),
+            partial(api.url, 'migration_release'),
             release_store,
+            migration.MigrationStore(store_client),
             partial(Release, store_command, store_query)))
     api.add(
         'instance', InstanceResource(
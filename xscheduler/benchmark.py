@@ -0,0 +1,489 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scheduler simulation and benchmark.
+
+Runs the real L{Scheduler}, L{Updater}, L{Terminator},
+L{ExecutorManager} and L{InstanceStoreQuery} against in-process
+stand-ins for etcd, redis, the service registry and the executors,
+and reports how fast pending instances are placed and brought to
+running.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+from collections import namedtuple
+from optparse import OptionParser
+import itertools
+import json
+import logging
+import random
+import resource
+import time
+
+from gevent.event import Event
+from gevent.queue import Queue
+import gevent
+import requests
+import shortuuid
+
+from etcd import EtcdError
+
+from .cache import WriteBehindStateCache
+from .executor import ExecutorManager
+from .scheduler import (RequirementRankPlacementPolicy, Scheduler,
+                        Updater, Terminator)
+from . import store
+
+
+_Event = namedtuple('_Event', 'action key value index')
+
+
+class FakeEtcd(object):
+    """In-memory etcd with watch semantics."""
+
+    def __init__(self):
+        self._data = {}
+        self._events = []
+        self._changed = Event()
+
+    def _record(self, action, key, value):
+        self._events.append(_Event(action, key, value, len(self._events) + 1))
+        changed, self._changed = self._changed, Event()
+        changed.set()
+
+    def get(self, key):
+        if key not in self._data:
+            raise EtcdError("key not found: %s" % (key,))
+        return _Event('GET', key, self._data[key], len(self._events))
+
+    def get_recursive(self, prefix):
+        prefix = prefix + '/'
+        return dict((key, value) for (key, value) in self._data.iteritems()
+                    if key.startswith(prefix))
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = value
+        self._record('SET', key, value)
+
+    def testandset(self, key, prev_value, value, ttl=None):
+        if self._data.get(key, '') != prev_value:
+            raise EtcdError("test failed: %s" % (key,))
+        self.set(key, value)
+
+    def delete(self, key):
+        if key not in self._data:
+            raise EtcdError("key not found: %s" % (key,))
+        del self._data[key]
+        self._record('DELETE', key, None)
+
+    def watch(self, prefix, index=None, timeout=None):
+        if index is None:
+            index = len(self._events) + 1
+        deadline = time.time() + (timeout or 0)
+        while True:
+            for event in itertools.islice(self._events, index - 1, None):
+                if event.key.startswith(prefix):
+                    return event
+                index = event.index + 1
+            remaining = deadline - time.time()
+            if timeout is not None and remaining <= 0:
+                return None
+            self._changed.wait(remaining if timeout is not None else None)
+
+
+class FakeRedis(object):
+    """In-memory redis, supporting the commands the state cache uses."""
+
+    def __init__(self):
+        self._data = {}
+        # counts round-trips; a pipeline counts as one.
+        self.commands = 0
+
+    def set(self, key, value, ex=None):
+        self.commands += 1
+        self._data[key] = value
+
+    def get(self, key):
+        self.commands += 1
+        return self._data.get(key)
+
+    def mget(self, keys):
+        self.commands += 1
+        return [self._data.get(key) for key in keys]
+
+    def publish(self, topic, message):
+        self.commands += 1
+        return 0
+
+    def expire(self, key, ttl):
+        self.commands += 1
+        return key in self._data
+
+    def sadd(self, key, *members):
+        self.commands += 1
+        self._data.setdefault(key, set()).update(members)
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline(object):
+    """Queues commands and runs them as one round-trip."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self._commands.append(
+            (method, args, kwargs))
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        self.redis.commands -= len(commands) - 1
+        return [method(*args, **kwargs)
+                for (method, args, kwargs) in commands]
+
+
+class _Response(object):
+
+    def __init__(self, status_code, data=None, headers=None, lines=()):
+        self.status_code = status_code
+        self._data = data
+        self.headers = headers or {}
+        self._lines = lines
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("%d" % (self.status_code,))
+
+
+class FakeExecutor(object):
+    """An executor that starts containers instantly, answering after
+    C{latency} seconds and failing C{failure_rate} of the changes.
+
+    Container listings support ETags and, if C{delta} is true, the
+    changes-since-version form.  If C{stream} is true container events
+    are also streamed, and if C{batch} is true several containers can
+    be created or deleted in one request.
+    """
+
+    def __init__(self, name, latency=0.0, failure_rate=0.0, delta=True,
+                 stream=False, batch=True):
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.delta = delta
+        self.stream = stream
+        self.batch = batch
+        self._subscribers = []
+        self.containers = {}
+        self.requests = 0
+        self._version = 0
+        self._changes = {}
+
+    def _changed(self, cid):
+        self._version += 1
+        self._changes[cid] = self._version
+        for queue in self._subscribers:
+            queue.put(self._event(cid))
+
+    def _event(self, cid):
+        event = {'id': cid, 'version': self._changes[cid]}
+        if cid in self.containers:
+            event['container'] = self.containers[cid]
+        else:
+            event['removed'] = True
+        return json.dumps(event)
+
+    def _events(self, params):
+        if not self.stream:
+            return _Response(404)
+        queue = Queue()
+        since = int((params or {}).get('since') or self._version)
+        for cid, version in sorted(self._changes.iteritems(),
+                                   key=lambda (cid, version): version):
+            if version > since:
+                queue.put(self._event(cid))
+        self._subscribers.append(queue)
+        return _Response(200, lines=queue)
+
+    def _list(self, headers, params):
+        version_headers = {'ETag': '"%d"' % (self._version,),
+                           'X-Container-Version': str(self._version)}
+        if (headers or {}).get('If-None-Match') == version_headers['ETag']:
+            return _Response(304, headers=version_headers)
+        since = (params or {}).get('since')
+        if not self.delta or since is None:
+            return _Response(200, self.containers, version_headers)
+        since = int(since)
+        changed = [cid for (cid, version) in self._changes.iteritems()
+                   if version > since]
+        return _Response(200, {
+                'changed': dict((cid, self.containers[cid])
+                                for cid in changed
+                                if cid in self.containers),
+                'removed': [cid for cid in changed
+                            if cid not in self.containers]},
+                         dict(version_headers, **{'X-Container-Delta': '1'}))
+
+    def _delay(self):
+        self.requests += 1
+        if self.latency:
+            gevent.sleep(random.expovariate(1.0 / self.latency))
+
+    def _fail(self):
+        return random.random() < self.failure_rate
+
+    def _create(self, container):
+        container.update(id=shortuuid.uuid(), state='running', reason=None)
+        self.containers[container['id']] = container
+        self._changed(container['id'])
+        return container
+
+    def _delete(self, cid):
+        del self.containers[cid]
+        self._changed(cid)
+
+    def _batch(self, data):
+        if not self.batch:
+            return _Response(404)
+        request = json.loads(data)
+        created = []
+        for container in request.get('create', []):
+            if self._fail():
+                created.append({'error': 'failed'})
+            else:
+                created.append({'container': self._create(container)})
+        deleted = []
+        for cid in request.get('delete', []):
+            if cid not in self.containers:
+                deleted.append({'error': 'no such container'})
+            elif self._fail():
+                deleted.append({'error': 'failed'})
+            else:
+                self._delete(cid)
+                deleted.append({'ok': True})
+        return _Response(200, {'create': created, 'delete': deleted})
+
+    def request(self, method, path, data=None, headers=None, params=None):
+        self._delay()
+        parts = path.strip('/').split('/')
+        if method == 'GET' and parts == ['container']:
+            return self._list(headers, params)
+        if method == 'GET' and parts == ['container', 'events']:
+            return self._events(params)
+        if method == 'POST' and parts == ['container', '_batch']:
+            return self._batch(data)
+        if self._fail():
+            return _Response(500)
+        if method == 'POST' and parts == ['container']:
+            return _Response(201, self._create(json.loads(data)))
+        cid = parts[1]
+        if cid not in self.containers:
+            return _Response(404)
+        if method == 'PUT':
+            container = json.loads(data)
+            container.update(id=cid, state='running', reason=None)
+            self.containers[cid] = container
+            self._changed(cid)
+            return _Response(200, container)
+        if method == 'DELETE':
+            self._delete(cid)
+            return _Response(204)
+        return _Response(405)
+
+
+class FakeSession(object):
+    """Stand-in for C{requests.Session} that routes requests to the
+    fake executors by host name.
+    """
+
+    def __init__(self, executors):
+        self.executors = executors
+
+    def _request(self, method, url, data=None, headers=None, params=None):
+        host, path = url[len('http://'):].split('/', 1)
+        executor = self.executors[host.split('.', 1)[0]]
+        return executor.request(method, path, data, headers, params)
+
+    def get(self, url, headers=None, params=None, stream=False,
+            timeout=None):
+        return self._request('GET', url, headers=headers, params=params)
+
+    def post(self, url, data=None):
+        return self._request('POST', url, data)
+
+    def put(self, url, data=None):
+        return self._request('PUT', url, data)
+
+    def delete(self, url):
+        return self._request('DELETE', url)
+
+
+class _FormationCache(object):
+
+    def __init__(self, executors):
+        self.executors = executors
+
+    def query(self):
+        return dict((name, {'instance': name, 'host': name})
+                    for name in self.executors)
+
+
+class FakeRegistry(object):
+
+    def __init__(self, executors):
+        self.executors = executors
+
+    def formation_cache(self, formation):
+        return _FormationCache(self.executors)
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(count, executors=100, latency=0.0, failure_rate=0.0,
+        interval=10, timeout=600, stream=False, batch=True):
+    """Create C{count} pending instances and wait for all of them to
+    be running.  Return a C{dict} of measurements.
+    """
+    fakes = dict((name, FakeExecutor(name, latency, failure_rate,
+                                     stream=stream, batch=batch))
+                 for name in ('executor%d' % (i,)
+                              for i in range(executors)))
+    etcd = FakeEtcd()
+    redis = FakeRedis()
+    store_command = store.InstanceStoreCommand(etcd)
+    store_query = store.InstanceStoreQuery(etcd, store_command)
+    manager = ExecutorManager(time, FakeRegistry(fakes), store_query,
+                              WriteBehindStateCache(redis), interval,
+                              session_factory=lambda: FakeSession(fakes),
+                              stream=stream)
+    services = [
+        Scheduler(time, store_query, manager,
+                  RequirementRankPlacementPolicy(),
+                  dispatch_rate=count),
+        Updater(time, store_query, manager),
+        Terminator(time, store_query, manager)
+        ]
+
+    created = {}
+    latencies = []
+    done = Event()
+
+    def _updated(inst):
+        if inst.state == inst.STATE_RUNNING and inst.name in created:
+            latencies.append(time.time() - created.pop(inst.name))
+            if len(latencies) == count:
+                done.set()
+
+    store_command.on('update', _updated)
+    store_query.start()
+    manager.start()
+    for service in services:
+        service.start()
+
+    cpu, start = _cpu(), time.time()
+    for n in xrange(count):
+        inst = store.create(store_command, 'bench', 'web', '1',
+                            'image', 'command')
+        created[inst.name] = time.time()
+        if n % 100 == 0:
+            gevent.sleep(0)
+    done.wait(timeout)
+    elapsed, cpu = time.time() - start, _cpu() - cpu
+
+    for service in services:
+        service.stop()
+    manager.stop()
+    store_query.stop()
+
+    latencies.sort()
+    return {
+        'instances': count,
+        'running': len(latencies),
+        'elapsed': elapsed,
+        'placed_per_second': len(latencies) / elapsed,
+        'p50': _percentile(latencies, 0.5),
+        'p90': _percentile(latencies, 0.9),
+        'p99': _percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else float('nan'),
+        'cpu': cpu,
+        'cpu_utilization': cpu / elapsed,
+        'executor_requests': sum(fake.requests for fake in fakes.values()),
+        'redis_round_trips': redis.commands,
+        }
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--instances", dest="instances",
+                      default="1000,10000,50000",
+                      help="comma separated instance counts", metavar="N")
+    parser.add_option("-e", "--executors", dest="executors", type=int,
+                      default=100, help="number of fake executors")
+    parser.add_option("-l", "--latency", dest="latency", type=float,
+                      default=0.0, help="mean executor latency (seconds)")
+    parser.add_option("-f", "--failure-rate", dest="failure_rate",
+                      type=float, default=0.0,
+                      help="fraction of executor changes that fail")
+    parser.add_option("-i", "--interval", dest="interval", type=int,
+                      default=10, help="executor check interval")
+    parser.add_option("-s", "--stream", dest="stream",
+                      action="store_true",
+                      help="stream container events from the executors")
+    parser.add_option("-b", "--no-batch", dest="batch",
+                      action="store_false", default=True,
+                      help="executors do not support batch requests")
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      action="store_true", help="show scheduler logs")
+    parser.add_option("-t", "--timeout", dest="timeout", type=int,
+                      default=600, help="give up after this many seconds")
+    (options, args) = parser.parse_args()
+
+    format = '%(asctime)s %(levelname)-8s %(name)s: %(message)s'
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.CRITICAL,
+        format=format)
+
+    for count in [int(n) for n in options.instances.split(',')]:
+        result = run(count, options.executors, options.latency,
+                     options.failure_rate, options.interval,
+                     options.timeout, options.stream, options.batch)
+        print ("%(instances)d instances: %(running)d running in "
+               "%(elapsed).2fs, %(placed_per_second).1f placed/s, "
+               "pending->running p50 %(p50).3fs p90 %(p90).3fs "
+               "p99 %(p99).3fs max %(max).3fs, "
+               "cpu %(cpu).2fs (%(cpu_utilization).0f%%), "
+               "%(executor_requests)d executor requests, "
+               "%(redis_round_trips)d redis round-trips") % dict(
+            result, cpu_utilization=result['cpu_utilization'] * 100)
@@ -48,7 +48,8 @@ def _create(store_command, formation, service, release, template):
                           image=template['image'],
                           command=template.get('command'),
                           env=template.get('env', {}),
-                          ports=template.get('ports', []))
+                          ports=template.get('ports', []),
+                          resources=template.get('resources'))
 
 
 def _deploy_instance(executor_manager, inst, name):
@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
 import logging
 import json
 import sys
+import time
 from functools import partial
 
+from gevent.event import Event
+import gevent
+
 from gilliam.errors import ResolveError
 
 from redis.connection import Connection as _Connection, ConnectionPool
@@ -40,25 +45,86 @@ class StateCache(object):
     def __init__(self, redis):
         self.redis = redis
 
+    def _data_key(self, formation, service, instance):
+        return '{0}:{1}:{2}'.format(formation, service, instance)
+
+    def _index_key(self, formation):
+        return 'instances:{0}'.format(formation)
+
     def save(self, formation, service, instance, data):
         """Save state for the specified service instance."""
+        self.save_many([(formation, service, instance, data)])
+
+    def save_many(self, items):
+        """Save state for several service instances in one pipeline.
+
+        @param items: C{(formation, service, instance, data)} tuples.
+        @return: The C{(formation, service, instance)} keys of the
+            items that could not be written.
+        """
+        if items and not self._try_write(items, ()):
+            return [tuple(item[:3]) for item in items]
+        return []
+
+    def refresh(self, keys):
+        """Refresh the TTL of the state of several service instances.
+
+        @param keys: C{(formation, service, instance)} tuples.
+        """
+        if keys:
+            self._try_write((), keys)
+
+    def _try_write(self, items, keys):
+        """Write C{items} and C{keys}, returning false if that
+        failed.
+        """
         try:
-            sdata = json.dumps(data)
-            data_key = '{0}:{1}:{2}'.format(formation, service, instance)
-            self.redis.set(data_key, sdata, ex=self.TTL)
-            topic = 'formation:{0}'.format(formation)
-            self.redis.publish(topic, sdata)
+            self._write(items, keys)
         except RedisError:
             log.debug('cannot talk to redis', exc_info=True)
         except ResolveError:
             pass
         except:
             log.exception("redis")
+        else:
+            return True
+        return False
+
+    def _write(self, items, keys):
+        """Save C{items} and refresh the TTL of C{keys} in one
+        pipeline.
+
+        The data keys of a formation are also added to its index set,
+        so that the state of a formation can be read without scanning
+        the whole keyspace.  Members of the set whose data key has
+        expired are removed when the formation is read, see
+        L{MirroredStateCache}.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        formations = set()
+        for formation, service, instance, data in items:
+            sdata = json.dumps(data)
+            data_key = self._data_key(formation, service, instance)
+            pipeline.set(data_key, sdata, ex=self.TTL)
+            pipeline.sadd(self._index_key(formation), data_key)
+            formations.add(formation)
+            topic = 'formation:{0}'.format(formation)
+            pipeline.publish(topic, json.dumps({
+                        'service': service, 'instance': instance,
+                        'status': data}))
+        for formation, service, instance in keys:
+            data_key = self._data_key(formation, service, instance)
+            pipeline.expire(data_key, self.TTL)
+            pipeline.sadd(self._index_key(formation), data_key)
+            formations.add(formation)
+        for formation in formations:
+            pipeline.expire(self._index_key(formation), self.TTL)
+        pipeline.execute()
 
     def get(self, formation, service, instance):
         try:
-            data_key = '{0}:{1}:{2}'.format(formation, service, instance)
-            data = self.redis.get(data_key)
+            data = self.redis.get(self._data_key(formation, service,
+                                                 instance))
             if data:
                 return json.loads(data)
             else:
@@ -69,9 +135,312 @@ class StateCache(object):
         except ResolveError:
             return {}
 
+    def get_many(self, keys):
+        """Return state for several service instances with one MGET.
+
+        @param keys: C{(formation, service, instance)} tuples.
+        @return: A list of state C{dict}s in the same order as
+            C{keys}.  Unknown instances have an empty C{dict}.
+        """
+        if not keys:
+            return []
+        try:
+            values = self.redis.mget([self._data_key(*key) for key in keys])
+            return [json.loads(data) if data else {} for data in values]
+        except RedisError:
+            log.debug('cannot talk to redis', exc_info=True)
+            return [{} for key in keys]
+        except ResolveError:
+            return [{} for key in keys]
+
+
+class WriteBehindStateCache(StateCache):
+    """State cache where saves never block.
+
+    Saves and TTL refreshes are put in a bounded queue that a
+    background greenlet drains in pipelined batches.  The queue is
+    keyed by service instance so a newer state replaces one that has
+    not been written yet.  When the queue is full new entries are
+    dropped, and L{save_many} returns their keys.  Failed batches are
+    put back in the queue, unless they have been superseded, and
+    retried after RETRY_INTERVAL.
+    """
+    MAX_QUEUE = 10000
+    BATCH_SIZE = 500
+    RETRY_INTERVAL = 5
+
+    def __init__(self, redis):
+        StateCache.__init__(self, redis)
+        self._queue = OrderedDict()
+        self._refresh = OrderedDict()
+        self._ready = Event()
+        self._writer = None
+        self.overwritten = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self._queue) + len(self._refresh)
+
+    def save_many(self, items):
+        dropped = [(formation, service, instance)
+                   for (formation, service, instance, data) in items
+                   if not self._put(self._queue,
+                                    (formation, service, instance), data)]
+        self._wakeup()
+        return dropped
+
+    def refresh(self, keys):
+        for key in keys:
+            self._put(self._refresh, tuple(key), None)
+        self._wakeup()
+
+    def _put(self, queue, key, value):
+        """Queue C{value} under C{key}, returning false if it was
+        dropped because the queue is full.
+        """
+        if key in queue:
+            self.overwritten += 1
+        elif self.depth >= self.MAX_QUEUE:
+            self.dropped += 1
+            if self.dropped % self.MAX_QUEUE == 1:
+                log.warning("state cache queue full, %d dropped so far" % (
+                        self.dropped,))
+            return False
+        queue[key] = value
+        return True
+
+    def _wakeup(self):
+        if self.depth:
+            self._ready.set()
+            if self._writer is None:
+                self._writer = gevent.spawn(self._drain)
+
+    def _take(self, queue):
+        return [queue.popitem(last=False)
+                for _ in range(min(self.BATCH_SIZE, len(queue)))]
+
+    def _drain(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            while self.depth:
+                items = self._take(self._queue)
+                keys = self._take(self._refresh)
+                try:
+                    self._write([key + (data,) for (key, data) in items],
+                                [key for (key, _) in keys])
+                except Exception, err:
+                    log.debug('cannot write to state cache: %s' % (err,))
+                    # put back what has not been superseded.
+                    for key, data in items:
+                        self._queue.setdefault(key, data)
+                    for key, _ in keys:
+                        self._refresh.setdefault(key, None)
+                    gevent.sleep(self.RETRY_INTERVAL)
+
+
+class MirroredStateCache(StateCache):
+    """State cache that keeps an in-memory mirror of the formations
+    that are read from it.
+
+    A formation is mirrored the first time it is read: we subscribe to
+    its topic, populate the mirror with a bulk read of the keys in
+    the index set of the formation and then keep it up to date from
+    the published changes.  Concurrent first reads of a formation wait
+    for the same load.  If the subscription drops the mirrors are
+    thrown away and reads go directly to redis until the subscription
+    has been re-established.
+
+    Every entry of the mirror has a deadline after which its key may
+    have expired in redis.  Since TTL refreshes are not published,
+    entries that are past their deadline are checked against redis
+    every SWEEP_INTERVAL seconds and dropped if their key is gone.
+    """
+    RETRY_INTERVAL = 5
+    SWEEP_INTERVAL = 60
+    BATCH_SIZE = 1000
+
+    def __init__(self, redis):
+        StateCache.__init__(self, redis)
+        self._mirrors = {}
+        self._loading = {}
+        self._loaded = {}
+        self._pubsub = None
+        self._listener = None
+        self._retry_at = 0
+        self._sweep_at = time.time() + self.SWEEP_INTERVAL
+
+    def get(self, formation, service, instance):
+        mirror = self._mirror(formation)
+        if mirror is None:
+            return StateCache.get(self, formation, service, instance)
+        return self._lookup(mirror, (service, instance))
+
+    def get_many(self, keys):
+        mirrors = dict((formation, self._mirror(formation))
+                       for formation in set(key[0] for key in keys))
+        missing = [key for key in keys if mirrors[key[0]] is None]
+        fetched = dict(zip(missing, StateCache.get_many(self, missing)))
+        return [fetched[key] if key in fetched
+                else self._lookup(mirrors[key[0]], key[1:])
+                for key in keys]
+
+    def _lookup(self, mirror, key):
+        entry = mirror.get(key)
+        return entry[0] if entry is not None else {}
+
+    def _mirror(self, formation):
+        """Return the mirror of C{formation}, or C{None} if there is no
+        subscription.
+        """
+        if time.time() >= self._sweep_at:
+            self._sweep()
+        mirror = self._mirrors.get(formation)
+        if mirror is None:
+            loaded = self._loaded.get(formation)
+            if loaded is not None:
+                loaded.wait()
+                mirror = self._mirrors.get(formation)
+            elif time.time() >= self._retry_at:
+                mirror = self._watch(formation)
+        return mirror
+
+    def _watch(self, formation):
+        # subscribe before reading so that no change is lost.  changes
+        # that arrive during the read are collected in _loading and
+        # take precedence over what was read.
+        self._loading[formation] = updates = {}
+        self._loaded[formation] = loaded = Event()
+        try:
+            if self._pubsub is None:
+                self._pubsub = self.redis.pubsub()
+            self._pubsub.subscribe('formation:{0}'.format(formation))
+            if self._listener is None:
+                self._listener = gevent.spawn(self._listen)
+            mirror = self._load(formation)
+            mirror.update(updates)
+            self._mirrors[formation] = mirror
+            return mirror
+        except (RedisError, ResolveError):
+            log.debug('cannot mirror formation %s' % (formation,),
+                      exc_info=True)
+            self._reset()
+            return None
+        finally:
+            del self._loading[formation]
+            del self._loaded[formation]
+            loaded.set()
+
+    def _load(self, formation):
+        index_key = self._index_key(formation)
+        keys = list(self.redis.smembers(index_key))
+        mirror, expired = {}, []
+        now = time.time()
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i + self.BATCH_SIZE]
+            for key, (data, ttl) in zip(batch, self._read(batch)):
+                if data:
+                    _formation, service, instance = key.split(':', 2)
+                    mirror[(service, instance)] = (
+                        json.loads(data), now + self._ttl(ttl))
+                else:
+                    expired.append(key)
+        if expired:
+            self.redis.srem(index_key, *expired)
+        return mirror
+
+    def _read(self, keys):
+        """Return C{(data, ttl)} of C{keys}, with the TTL in
+        milliseconds.
+        """
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key)
+            pipeline.pttl(key)
+        results = pipeline.execute()
+        return zip(results[::2], results[1::2])
+
+    def _ttl(self, pttl):
+        # keys without a TTL are checked again after the default TTL.
+        return pttl / 1000.0 if pttl >= 0 else self.TTL
+
+    def _sweep(self):
+        """Drop mirrored entries whose key has expired in redis, and
+        extend the deadline of the others.
+        """
+        now = time.time()
+        self._sweep_at = now + self.SWEEP_INTERVAL
+        entries = [(formation, key, entry)
+                   for (formation, mirror) in self._mirrors.items()
+                   for (key, entry) in mirror.items()
+                   if entry[1] <= now]
+        if not entries:
+            return
+        try:
+            results = self._read([self._data_key(formation, *key)
+                                  for (formation, key, _) in entries])
+        except (RedisError, ResolveError):
+            log.debug('cannot sweep mirrors', exc_info=True)
+            return
+        for (formation, key, entry), (data, ttl) in zip(entries, results):
+            mirror = self._mirrors.get(formation)
+            # the entry may have been replaced while reading.
+            if mirror is None or mirror.get(key) is not entry:
+                continue
+            if data:
+                mirror[key] = (entry[0], now + self._ttl(ttl))
+            else:
+                del mirror[key]
+
+    def _listen(self):
+        try:
+            for message in self._pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                formation = message['channel'].split(':', 1)[1]
+                mirror = self._mirrors.get(formation)
+                if mirror is None:
+                    mirror = self._loading.get(formation)
+                if mirror is not None:
+                    data = json.loads(message['data'])
+                    mirror[(data['service'], data['instance'])] = (
+                        data['status'], time.time() + self.TTL)
+        except (RedisError, ResolveError):
+            log.debug('subscription dropped', exc_info=True)
+        except:
+            log.exception("redis")
+        self._listener = None
+        self._reset()
+
+    def _reset(self):
+        """Drop all mirrors and the subscription."""
+        self._mirrors.clear()
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+        if self._listener is not None:
+            self._listener.kill(block=False)
+            self._listener = None
+        self._retry_at = time.time() + self.RETRY_INTERVAL
+
+
+def make_client(resolver, host, port=6379, mirror=False,
+                write_behind=False):
+    """Make a state cache client.
 
-def make_client(resolver, host, port=6379):
-    """Make a state cache client."""
+    @param mirror: Keep an in-memory mirror of the state of the
+        formations that are read, see L{MirroredStateCache}.
+    @param write_behind: Queue saves and write them in the
+        background, see L{WriteBehindStateCache}.
+    """
     redis = StrictRedis(connection_pool=ConnectionPool(
         host=host, port=port, connection_class=partial(RedisConnection, resolver)))
+    if mirror:
+        return MirroredStateCache(redis)
+    if write_behind:
+        return WriteBehindStateCache(redis)
     return StateCache(redis)
@@ -13,24 +13,50 @@
 # limitations under the License.
 
 from gevent.event import Event
+from gevent.pool import Pool
 import gevent
 import requests
 import json
 import logging
+import random
 
-from glock.task import LoopingCall
+import pyee
+
+from .store import spec_fingerprint
+from .util import CircuitBreaker, RecurringTask
 
 
 class _Container(dict):
     __getattr__ = dict.get
 
 
+def _container(data):
+    """Return a L{_Container} for C{data}.
+
+    Executors echo the fingerprint that they were given.  Containers
+    of executors that do not are fingerprinted here.
+    """
+    container = _Container(**data)
+    if container.fingerprint is None:
+        container['fingerprint'] = spec_fingerprint(
+            container.image, container.command, container.env,
+            container.ports)
+    return container
+
+
 class _APIClient(object):
+    # the executor is expected to send an empty keepalive line on the
+    # event stream at least this often.  a stream that is silent for
+    # longer, for example because the connection is half-open, is
+    # treated as dropped.
+    STREAM_IDLE_TIMEOUT = 30
 
     def __init__(self, httpclient, name, formation):
         self.httpclient = httpclient
         self.name = name
         self.formation = formation
+        self._etag = None
+        self._version = None
 
     @property
     def _url(self):
@@ -42,7 +68,8 @@ class _APIClient(object):
             'image': instance.image, 'command': instance.command,
             'formation': instance.formation, 'service': instance.service,
             'instance': instance.instance, 'env': instance.env or {},
-            'ports': instance.ports or []
+            'ports': instance.ports or [],
+            'fingerprint': instance.fingerprint
             }
 
     # methods for talking to the executor via the API.  break out
@@ -53,25 +80,126 @@ class _APIClient(object):
         response = self.httpclient.post('%s/container' % (self._url,),
                                         data=json.dumps(request))
         response.raise_for_status()
-        return _Container(**response.json())
+        return _container(response.json())
 
     def restart(self, cid, inst):
         request = self._build_container_request(inst)
         response = self.httpclient.put('%s/container/%s' % (self._url, cid),
                                        data=json.dumps(request))
         response.raise_for_status()
-        return _Container(**response.json())
+        return _container(response.json())
 
     def delete(self, cid):
         response = self.httpclient.delete('%s/container/%s' % (
                 self._url, cid))
         response.raise_for_status()
 
+    def batch(self, create=(), delete=()):
+        """Create and delete several containers in one request.
+
+        Returns a C{(created, deleted)} tuple with one result per
+        item: the created L{_Container} or C{True} when the item
+        succeeded, and an error message when it failed.  Raises
+        L{BatchUnsupported} if the executor has no batch endpoint.
+        """
+        request = {
+            'create': [self._build_container_request(inst)
+                       for inst in create],
+            'delete': list(delete)}
+        response = self.httpclient.post('%s/container/_batch' % (self._url,),
+                                        data=json.dumps(request))
+        if response.status_code in (404, 405, 501):
+            raise BatchUnsupported(str(response.status_code))
+        response.raise_for_status()
+        results = response.json()
+        created = [_container(result['container']) if 'container' in result
+                   else result.get('error', 'unknown error')
+                   for result in results.get('create', [])]
+        deleted = [True if result.get('ok') else
+                   result.get('error', 'unknown error')
+                   for result in results.get('delete', [])]
+        return created, deleted
+
     def containers(self):
+        """Return a full listing of the containers of the executor."""
         response = self.httpclient.get('%s/container' % (self._url,))
         response.raise_for_status()
-        return {cid: _Container(**value)
-                for (cid, value) in response.json().iteritems()}
+        self._remember_version(response)
+        return self._parse(response.json())
+
+    def changes(self):
+        """Return the containers that changed since the last listing.
+
+        Returns a C{(changed, removed)} tuple, where C{changed} maps
+        container IDs to containers and C{removed} lists the IDs of
+        containers that are gone.
+
+        The listing is conditional on the ETag of the previous one.
+        If the executor reported a version we ask for the changes
+        since that version; executors that support it answer with a
+        C{X-Container-Delta} header and a C{changed}/C{removed}
+        body.  Other executors answer with a full listing, in which
+        case all containers are returned as changed and nothing as
+        removed.
+        """
+        headers, params = {}, {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._version is not None:
+            params['since'] = self._version
+        response = self.httpclient.get('%s/container' % (self._url,),
+                                       headers=headers, params=params)
+        if response.status_code == 304:
+            return {}, []
+        response.raise_for_status()
+        self._remember_version(response)
+        data = response.json()
+        if response.headers.get('X-Container-Delta'):
+            return self._parse(data['changed']), data.get('removed', [])
+        return self._parse(data), []
+
+    def events(self, connected=None):
+        """Iterate over container events streamed by the executor.
+
+        The executor streams one JSON object per line, each with the
+        container C{id}, the C{version} after the change and either
+        the C{container} or C{removed}.  Yields C{(cid, container)}
+        pairs, where container is C{None} if it was removed.  Raises
+        L{EventStreamUnsupported} if the executor has no event
+        stream, and a C{requests} error if nothing, not even a
+        keepalive line, arrives for STREAM_IDLE_TIMEOUT seconds.
+
+        @param connected: Called without arguments once the executor
+            has accepted the stream, before any event has arrived.
+        """
+        params = {}
+        if self._version is not None:
+            params['since'] = self._version
+        response = self.httpclient.get('%s/container/events' % (self._url,),
+                                       params=params, stream=True,
+                                       timeout=self.STREAM_IDLE_TIMEOUT)
+        if response.status_code in (404, 405, 501):
+            raise EventStreamUnsupported(str(response.status_code))
+        response.raise_for_status()
+        if connected is not None:
+            connected()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            self._version = event.get('version', self._version)
+            if event.get('removed'):
+                yield event['id'], None
+            else:
+                yield event['id'], _container(event['container'])
+
+    def _remember_version(self, response):
+        self._etag = response.headers.get('ETag')
+        self._version = response.headers.get('X-Container-Version')
+
+    def _parse(self, data):
+        return {cid: _container(value)
+                for (cid, value) in data.iteritems()}
 
 
 class ExecutorError(Exception):
@@ -82,33 +210,125 @@ class DispatchError(ExecutorError):
     pass
 
 
-class _ExecutorController(object):
+class EventStreamUnsupported(ExecutorError):
+    pass
+
+
+class BatchUnsupported(ExecutorError):
+    pass
+
+
+class _ExecutorController(pyee.EventEmitter):
+    """Keeps track of the containers of an executor.
+
+    Emits C{change} with the container whenever a container is new or
+    has changed, and C{load} with the controller whenever the number
+    of containers or the health of the executor may have changed.
+    """
+    # how often the TTL of the state of our containers is refreshed in
+    # the state cache.  changed state is written on every poll.
+    REFRESH_INTERVAL = 60 * 60
+
+    # while the event stream is up we only poll this often, to
+    # reconcile.  a dropped or idle stream, see _APIClient, is
+    # reconnected after STREAM_RETRY and polled at the normal rate
+    # until then.
+    FALLBACK_INTERVAL = 5 * 60
+    STREAM_RETRY = 5
+
+    # the executor is polled MIN_INTERVAL seconds after activity, and
+    # the interval then doubles for every quiet poll up to
+    # MAX_BACKOFF times the configured interval.  JITTER spreads the
+    # polls of different executors.
+    MIN_INTERVAL = 1
+    MAX_BACKOFF = 6
+    JITTER = 0.2
 
     def __init__(self, clock, name, apiclient, store_query, state_cache,
-                 interval):
+                 interval, tags=(), host=None, domain=None, capacity=None,
+                 stream=False):
+        pyee.EventEmitter.__init__(self)
         self.log = logging.getLogger('executor.controller.%s' % (name,))
         self.name = name
+        self.tags = list(tags or ())
+        self.host = host
+        self.domain = domain
+        self.capacity = capacity or {}
         self.apiclient = apiclient
         self.store_query = store_query
         self.state_cache = state_cache
         self.interval = interval
-        self._problematic = True
+        self._breaker = CircuitBreaker(clock, self.log)
+        self._stale = True
         self._terminated = []
         self._containers = {}
-        self._task = LoopingCall(clock, self._check_status)
+        self._by_instance = {}
+        self._saved = {}
+        self._unsaved = {}
+        self._clock = clock
+        self._refreshed = clock.time()
+        self._delay = self.MIN_INTERVAL
+        self._runner = RecurringTask(interval * self.MAX_BACKOFF,
+                                     self._poll, self.MIN_INTERVAL)
         self._started = Event()
+        self._stream_events = stream
+        self._batching = True
+        self._streamer = None
+        self._streaming = False
+        self._polled = None
 
     def containers(self):
         return self._containers.keys()
 
-    def start(self):
-        self._task.start(self.interval)
-        self._started.wait()
+    def container_count(self):
+        return len(self._containers)
+
+    def allocated(self):
+        """Return the resources requested by the instances that are
+        assigned to this executor, as a C{dict}.
+        """
+        allocated = {}
+        for inst in self.store_query.query_assigned(self.name):
+            if (inst.state == inst.STATE_TERMINATED
+                    or inst.state == inst.STATE_LOST):
+                continue
+            resources = inst.resources
+            if not isinstance(resources, dict):
+                continue
+            for resource, amount in resources.iteritems():
+                # records written before resources were validated may
+                # hold anything; those amounts are not counted.
+                if (isinstance(amount, (int, long, float))
+                        and not isinstance(amount, bool)):
+                    allocated[resource] = allocated.get(resource, 0) + amount
+        return allocated
+
+    def start(self, timeout=None):
+        """Start polling the executor and wait for the first contact.
+
+        If the executor cannot be reached within C{timeout} seconds
+        its circuit is opened, and polling continues in the
+        background.
+        """
+        self._runner.start()
+        if self._stream_events:
+            self._streamer = gevent.spawn(self._stream)
+        if not self._started.wait(timeout):
+            self.log.warning("no contact with executor after %s seconds"
+                             % (timeout,))
+            self._breaker.trip()
+            self.emit('load', self)
         return self
 
+    def stop(self):
+        self._runner.stop()
+        if self._streamer is not None:
+            self._streamer.kill(block=False)
+
     def dispatch(self, inst):
         container = self._handle_error(self.apiclient.create, inst)
         self._remember(container.id, container)
+        self._activity()
 
     def statuses(self, instances):
         for instance in instances:
@@ -116,36 +336,205 @@ class _ExecutorController(object):
             yield (container.state if container is not None
                    else 'unknown')
 
+    def dispatch_many(self, insts):
+        """Dispatch several instances, in one request if the executor
+        supports it.
+
+        Returns a list with C{None} for every instance that was
+        dispatched and a L{DispatchError} for those that were not.
+        """
+        if len(insts) > 1 and self._batching:
+            try:
+                created, _ = self._batch(create=insts)
+            except BatchUnsupported:
+                pass
+            else:
+                if len(created) < len(insts):
+                    # the executor may still have created the missing
+                    # ones; reconcile with a full listing.
+                    self._stale = True
+                    created = list(created) + [
+                        "no result in batch response"] * (
+                        len(insts) - len(created))
+                errors = []
+                for result in created[:len(insts)]:
+                    if isinstance(result, _Container):
+                        self._remember(result.id, result, flush=False)
+                        errors.append(None)
+                    else:
+                        errors.append(DispatchError(result))
+                self._flush()
+                self._activity()
+                return errors
+        return [self._try(self.dispatch, inst) for inst in insts]
+
+    def _batch(self, create=(), delete=()):
+        """Call the batch endpoint, remembering if the executor does
+        not support it.
+        """
+        try:
+            return self._handle_error(self.apiclient.batch, create, delete)
+        except BatchUnsupported:
+            self.log.info("executor does not support batches")
+            self._batching = False
+            raise
+
+    def _try(self, m, *args):
+        try:
+            m(*args)
+        except DispatchError, err:
+            return err
+
     def delete(self, instance):
         """Delete instance."""
         container = self.find(instance)
         if container is not None:
             self._forget(container.id)
+            self._activity()
             try:
                 self._handle_error(self.apiclient.delete, container.id)
             except Exception:
-                self._terminated.add(container.id)
+                self._terminated.append(container.id)
                 raise
 
+    def delete_many(self, instances):
+        """Delete several instances, in one request if the executor
+        supports it.
+
+        Returns a list with C{None} for every instance that was
+        deleted and a L{DispatchError} for those that were not.
+        """
+        containers = [self.find(instance) for instance in instances]
+        cids = [container.id for container in containers
+                if container is not None]
+        if len(cids) > 1 and self._batching:
+            for cid in cids:
+                self._forget(cid)
+            self._activity()
+            try:
+                _, deleted = self._batch(delete=cids)
+            except BatchUnsupported:
+                pass
+            except DispatchError, err:
+                self._terminated.extend(cids)
+                return [err] * len(instances)
+            else:
+                results = dict(zip(cids, deleted))
+                errors = []
+                for container in containers:
+                    # a container that is missing from a short response
+                    # is treated as not deleted and retried.
+                    result = (results.get(container.id, "no result in "
+                                          "batch response")
+                              if container is not None else True)
+                    if result is True:
+                        errors.append(None)
+                    else:
+                        self._terminated.append(container.id)
+                        errors.append(DispatchError(result))
+                return errors
+            for container, instance in zip(containers, instances):
+                # forgotten above; remember them again so that the
+                # single deletes below can find them.
+                if container is not None:
+                    self._remember(container.id, container, flush=False)
+        return [self._try(self.delete, instance) for instance in instances]
+
     def restart(self, instance):
         container = self.find(instance)
         if container is not None:
             container = self._handle_error(
                 self.apiclient.restart, container.id, instance)
             self._remember(container.id, container)
+            self._activity()
 
-    def _check_status(self):
+    def _activity(self):
+        """Poll soon, since something is about to change."""
+        self._delay = self.MIN_INTERVAL
+        self._runner.touch()
+
+    def _poll(self):
         try:
-            containers = self.apiclient.containers()
+            changed = self._check_status()
         except Exception:
-            raise
+            self.log.debug("cannot poll executor", exc_info=True)
+            self._stale = True
+            changed = False
+        if changed:
+            self._delay = self.MIN_INTERVAL
         else:
-            if self._problematic:
-                self._reconcile(containers)
-                self._problematic = False
-            for id, container in containers.items():
-                self._remember(id, container)
+            self._delay = min(self._delay * 2,
+                              self.interval * self.MAX_BACKOFF)
+        self._runner.retry(self._delay * random.uniform(
+                1 - self.JITTER, 1 + self.JITTER))
+
+    def _stream(self):
+        """Apply container events as the executor streams them."""
+        # start from the version of the first listing.
+        self._started.wait()
+        while True:
+            try:
+                for cid, container in self.apiclient.events(
+                        connected=self._connected):
+                    if container is None:
+                        self._lose([cid])
+                    else:
+                        self._remember(cid, container)
+            except EventStreamUnsupported:
+                self.log.info("executor has no event stream; polling")
+                return
+            except Exception:
+                self.log.debug("event stream failed", exc_info=True)
+            finally:
+                self._streaming = False
+            self._clock.sleep(self.STREAM_RETRY)
+
+    def _connected(self):
+        # events now arrive as they happen, so that polling can back
+        # off even if the executor is idle.
+        self._streaming = True
+
+    def _check_status(self):
+        """Poll the executor for changes.
+
+        Returns true if anything changed.
+        """
+        if (self._streaming and not self._stale
+                and self._clock.time() - self._polled
+                < self.FALLBACK_INTERVAL):
+            return False
+        self._polled = self._clock.time()
+        if self._stale:
+            containers = self._call(self.apiclient.containers)
+            self._reconcile(containers)
+            self._stale = False
+            removed = []
+        else:
+            containers, removed = self._call(self.apiclient.changes)
+        changed = [(id, container) for (id, container) in containers.items()
+                   if self._containers.get(id) != container]
+        for id, container in changed:
+            self._remember(id, container, flush=False)
+        if removed:
+            self._lose(removed)
+        self._flush()
+        if self._clock.time() - self._refreshed > self.REFRESH_INTERVAL:
+            self._refresh()
         self._started.set()
+        return bool(changed or removed)
+
+    def _lose(self, cids):
+        """Mark instances of containers that the executor says are
+        gone as lost, and forget the containers.
+        """
+        for cid in cids:
+            container = self._containers.get(cid)
+            if container is None:
+                continue
+            inst = self._geti(container)
+            if inst is not None and inst.state != inst.STATE_LOST:
+                inst.set_state(inst.STATE_LOST)
+            self._forget(cid)
 
     def _reconcile(self, containers):
         self._reconcile_missing_containers(containers)
@@ -176,16 +565,47 @@ class _ExecutorController(object):
     def _delete_terminated_containers(self, containers):
         for cid in self._terminated:
             if cid in containers:
-                self._client.delete(cid)
+                self.apiclient.delete(cid)
         del self._terminated[:]
 
+    def available(self):
+        """Return true unless the circuit of the executor is open."""
+        return self._breaker.available()
+
+    def health(self):
+        """Return the health score of the executor, see
+        L{CircuitBreaker.health}.
+        """
+        return self._breaker.health()
+
+    def _call(self, m, *args, **kwargs):
+        """Call the executor, recording the outcome and latency of the
+        call with the circuit breaker.
+        """
+        start = self._clock.time()
+        ok = False
+        try:
+            result = m(*args, **kwargs)
+            ok = True
+            return result
+        except BatchUnsupported:
+            ok = True
+            raise
+        finally:
+            self._breaker.record(ok, self._clock.time() - start)
+            self.emit('load', self)
+
     def _handle_error(self, m, *args, **kwargs):
-        if self._problematic:
-            raise DispatchError("problematic")
+        if not self._breaker.allow():
+            raise DispatchError("circuit open")
         try:
-            return m(*args, **kwargs)
+            return self._call(m, *args, **kwargs)
+        except BatchUnsupported:
+            raise
         except Exception, err:
-            self._problematic = True
+            # our view of the containers may be off; resync on the
+            # next poll.
+            self._stale = True
             raise DispatchError(str(err))
 
     def _geti(self, container):
@@ -195,30 +615,95 @@ class _ExecutorController(object):
 
     def find(self, inst):
         """Lookup container based on instance."""
-        for container in self._containers.itervalues():
-            if (container.formation == inst.formation
-                   and container.service == inst.service
-                   and container.instance == inst.instance):
-                return container
-        return None
-
-    def _remember(self, cid, container):
+        cid = self._by_instance.get(
+            (inst.formation, inst.service, inst.instance))
+        return self._containers.get(cid) if cid is not None else None
+
+    def _container_key(self, container):
+        return (container.formation, container.service,
+                container.instance)
+
+    def _remember(self, cid, container, flush=True):
+        """Remember container, and queue its status for the state
+        cache if it changed.  Queued statuses are written on
+        C{flush}.
+        """
+        previous = self._containers.get(cid)
+        if previous is not None:
+            self._by_instance.pop(self._container_key(previous), None)
         self._containers[cid] = container
+        key = self._container_key(container)
+        self._by_instance[key] = cid
         status = {'state': container.state, 'reason': container.reason}
-        self.state_cache.save(container.formation,
-                              container.service,
-                              container.instance,
-                              status)
+        if self._saved.get(key) != status:
+            self._unsaved[key] = status
+        if flush:
+            self._flush()
+        if previous != container:
+            self.emit('change', container)
+        if previous is None:
+            self.emit('load', self)
+
+    def _flush(self):
+        """Write changed statuses to the state cache in one go.
+
+        Statuses that could not be written are kept for the next
+        flush.
+        """
+        if self._unsaved:
+            unsaved, self._unsaved = self._unsaved, {}
+            failed = self.state_cache.save_many([key + (status,)
+                                                 for (key, status)
+                                                 in unsaved.iteritems()])
+            for key in failed:
+                status = unsaved.pop(key)
+                # the container may be gone, or a newer status may
+                # have arrived, while writing.
+                if key in self._by_instance:
+                    self._unsaved.setdefault(key, status)
+            self._saved.update(unsaved)
+
+    def _refresh(self):
+        """Refresh the TTL of the statuses that we have saved."""
+        self._refreshed = self._clock.time()
+        self.state_cache.refresh(self._saved.keys())
 
     def _forget(self, cid):
-        del self._containers[cid]
-
-
-class ExecutorManager(object):
+        container = self._containers.pop(cid)
+        self.emit('load', self)
+        key = self._container_key(container)
+        if self._by_instance.get(key) == cid:
+            del self._by_instance[key]
+            self._saved.pop(key, None)
+            self._unsaved.pop(key, None)
+
+
+class ExecutorManager(pyee.EventEmitter):
+    """Keeps a controller for every executor in the registry.
+
+    The executor formation is re-read every MEMBERSHIP_INTERVAL
+    seconds.  Controllers are started for new executors, and those of
+    executors that have been gone for REMOVE_GRACE seconds are stopped
+    and their instances handed back to the scheduler.
+
+    Emits C{container} with the container whenever a container on
+    any of the executors is new or has changed.
+    """
+    # number of executors that are contacted at the same time when
+    # they are added, and how long we wait for each of them.
+    START_CONCURRENCY = 20
+    START_TIMEOUT = 10
+
+    MEMBERSHIP_INTERVAL = 5
+    REMOVE_GRACE = 30
 
     def __init__(self, clock, registry, store_query, state_cache,
-                 interval, formation='executor'):
+                 interval, formation='executor',
+                 session_factory=requests.Session, stream=False):
+        pyee.EventEmitter.__init__(self)
         self.clock = clock
+        self.stream = stream
+        self.session_factory = session_factory
         self.registry = registry
         self.store_query = store_query
         self.check_interval = interval
@@ -226,41 +711,128 @@ class ExecutorManager(object):
         self.state_cache = state_cache
         self._form_cache = None
         self._client = {}
+        self._missing = {}
+        self._membership = RecurringTask(self.MEMBERSHIP_INTERVAL,
+                                         self._sync)
 
     def start(self):
         """Start manager."""
         self._form_cache = self.registry.formation_cache(self.formation)
-        for name, data in self._form_cache.query().items():
-            self._create(data['instance'])
-        # FIXME: make sure that we re-populate with new entries.
+        # the controllers are in place when we return; the task takes
+        # over from the next interval.
+        self._sync()
+        self._membership.start(now=False)
+
+    def stop(self):
+        """Stop polling the executors."""
+        self._membership.stop()
+        for client in self._client.values():
+            client.stop()
+
+    def _sync(self):
+        """Bring the controllers in line with the executor formation."""
+        try:
+            entries = self._form_cache.query()
+        except Exception:
+            logging.exception("cannot read executor formation")
+            return
+        pool = Pool(self.START_CONCURRENCY)
+        for data in entries.values():
+            self._missing.pop(data['instance'], None)
+            if data['instance'] not in self._client:
+                pool.spawn(self._create, data)
+        pool.join()
+
+        present = set(data['instance'] for data in entries.values())
+        now = self.clock.time()
+        for name in self._client.keys():
+            if name in present:
+                continue
+            # registrations can lapse for a moment, so give the
+            # executor a chance to come back.
+            since = self._missing.setdefault(name, now)
+            if now - since >= self.REMOVE_GRACE:
+                self._remove(name)
+
+    def _remove(self, name):
+        """Stop the controller of an executor that has left, and make
+        its instances available for rescheduling.
+        """
+        logging.info("executor %s is gone" % (name,))
+        self._client.pop(name).stop()
+        self._missing.pop(name, None)
+        for inst in list(self.store_query.query_assigned(name)):
+            if inst.state == inst.STATE_SHUTTING_DOWN:
+                inst.set_state(inst.STATE_TERMINATED)
+            elif inst.state != inst.STATE_TERMINATED:
+                inst.update(state=inst.STATE_PENDING, assigned_to=None)
 
     def get(self, name):
         return self._client.get(name)
 
+    def _get(self, name):
+        client = self._client.get(name)
+        if client is None:
+            raise DispatchError("unknown executor %s" % (name,))
+        return client
+
     def clients(self):
         return self._client.values()
 
-    def _create(self, name):
-        """Create ..."""
-        apiclient = _APIClient(requests.Session(), name, self.formation)
-        self._client[name] = _ExecutorController(
+    def _create(self, data):
+        """Create a controller for the executor described by the
+        registry entry C{data}.
+
+        Besides the instance name the entry may advertise C{tags},
+        C{host}, C{domain} and the C{capacity} of the executor
+        (C{cpu} and C{memory}) that the placement policies use.
+        """
+        name = data['instance']
+        apiclient = _APIClient(self.session_factory(), name, self.formation)
+        controller = _ExecutorController(
             self.clock, name, apiclient, self.store_query, self.state_cache,
-            self.check_interval).start()
+            self.check_interval, tags=data.get('tags', ()),
+            host=data.get('host'), domain=data.get('domain'),
+            capacity=data.get('capacity'), stream=self.stream)
+        controller.on('change', self._container_changed)
+        self._client[name] = controller
+        controller.start(self.START_TIMEOUT)
+
+    def _container_changed(self, container):
+        self.emit('container', container)
 
     def dispatch(self, inst, name):
         """Dispatch C{inst} to C{name}."""
         logging.info("DISPATCH %r to %s: %r" % (inst, name, self._client))
-        self.get(name).dispatch(inst)
+        self._get(name).dispatch(inst)
+
+    def dispatch_many(self, insts, name):
+        """Dispatch C{insts} to C{name}, batching the requests.
+
+        Returns a list with C{None} or a L{DispatchError} for each
+        instance.
+        """
+        logging.info("DISPATCH %d instances to %s" % (len(insts), name))
+        return self._get(name).dispatch_many(insts)
 
     def restart(self, inst):
-        self.get(inst.assigned_to).restart(inst)
+        self._get(inst.assigned_to).restart(inst)
 
     def terminate(self, inst):
-        self.get(inst.assigned_to).delete(inst)
+        self._get(inst.assigned_to).delete(inst)
+
+    def terminate_many(self, insts, name):
+        """Terminate C{insts}, which are all assigned to C{name},
+        batching the requests.
+
+        Returns a list with C{None} or a L{DispatchError} for each
+        instance.
+        """
+        return self._get(name).delete_many(insts)
 
     def wait(self, instance, name, timeout=None):
         """Wait an instance to boot or to fail."""
-        client = self.get(name)
+        client = self._get(name)
         with gevent.Timeout(timeout):
             while True:
                 status, = client.statuses([instance])
@@ -275,4 +847,4 @@ class ExecutorManager(object):
                 yield None
             else:
                 client = self.get(instance.assigned_to)
-                yield client.find(instance)
+                yield client.find(instance) if client is not None else None
@@ -0,0 +1,260 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Column-oriented view of the executor fleet.
+
+Simple placement expressions are translated into functions that
+evaluate them over every executor at once with NumPy.  Expressions
+that cannot be translated raise L{NotVectorizable}, and the caller
+is expected to fall back to evaluating them per executor.
+"""
+
+import ast
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_RESOURCES = ('cpu', 'memory')
+
+
+class NotVectorizable(Exception):
+    """The expression cannot be evaluated over the fleet."""
+
+
+def _encode(values):
+    """Return a code table and an array of codes for C{values}."""
+    codes = {}
+    return codes, numpy.array([codes.setdefault(value, len(codes))
+                               for value in values], dtype=numpy.int32)
+
+
+class Fleet(object):
+    """Executor attributes stored as column arrays.
+
+    Tags are kept as bitsets, one bit per distinct tag, and host and
+    domain names as integer codes.  C{assigned} counts instances that
+    have been placed on an executor during the current pass and is
+    included in C{ncont}.  C{health} and C{available} mirror the
+    circuit breakers of the executors.
+
+    The container counts and health are kept up to date from the
+    C{load} events of the executors, so that L{refresh} only has to
+    re-read the executors that changed.  Call L{close} when the fleet
+    is no longer used.
+    """
+
+    def __init__(self, executors):
+        self.executors = list(executors)
+        size = len(self.executors)
+        self._indexes = dict((executor.name, index)
+                             for (index, executor)
+                             in enumerate(self.executors))
+        self._ncont = numpy.zeros(size)
+        self.health = numpy.zeros(size)
+        self.available = numpy.zeros(size, dtype=bool)
+        self._dirty = set(range(size))
+        for executor in self.executors:
+            executor.on('load', self._changed)
+        self.refresh()
+        self._tag_bits = {}
+        for executor in self.executors:
+            for tag in executor.tags:
+                self._tag_bits.setdefault(tag, len(self._tag_bits))
+        self._tags = numpy.zeros((size, len(self._tag_bits) // 64 + 1),
+                                 dtype=numpy.uint64)
+        for index, executor in enumerate(self.executors):
+            for tag in executor.tags:
+                bit = self._tag_bits[tag]
+                self._tags[index, bit // 64] |= numpy.uint64(1 << (bit % 64))
+        self._hosts, self._host = _encode(
+            executor.host for executor in self.executors)
+        self._domains, self._domain = _encode(
+            executor.domain for executor in self.executors)
+        self._capacity = dict(
+            (resource, numpy.array([executor.capacity.get(resource, 0)
+                                    for executor in self.executors],
+                                   dtype=float))
+            for resource in _RESOURCES)
+
+    def __len__(self):
+        return len(self.executors)
+
+    def close(self):
+        for executor in self.executors:
+            executor.remove_listener('load', self._changed)
+
+    def _changed(self, executor):
+        index = self._indexes.get(executor.name)
+        if index is not None:
+            self._dirty.add(index)
+
+    def refresh(self):
+        """Re-read the container counts and health of the executors
+        that changed, and forget about assigned instances.  The other
+        columns are assumed to be static.
+        """
+        self.assigned = numpy.zeros(len(self.executors))
+        dirty, self._dirty = self._dirty, set()
+        for index in dirty:
+            executor = self.executors[index]
+            self._ncont[index] = executor.container_count()
+            self.health[index] = executor.health()
+            self.available[index] = executor.available()
+
+    @property
+    def ncont(self):
+        return self._ncont + self.assigned
+
+    def rank_vars(self, index):
+        """Return the rank variables of the executor at C{index}."""
+        return {'ncont': self._ncont.item(index) + self.assigned.item(index),
+                'cpu': self._capacity['cpu'].item(index),
+                'memory': self._capacity['memory'].item(index),
+                'health': self.health.item(index)}
+
+    def capacity(self, resource):
+        return self._capacity[resource]
+
+    def has_tag(self, tag):
+        """Return a boolean array that is true for executors that
+        have C{tag}.
+        """
+        bit = self._tag_bits.get(tag)
+        if bit is None:
+            return numpy.zeros(len(self), dtype=bool)
+        word = self._tags[:, bit // 64]
+        return (word & numpy.uint64(1 << (bit % 64))) != 0
+
+    def equals(self, name, value):
+        """Return a boolean array that is true for executors where the
+        attribute C{name} (C{host} or C{domain}) is C{value}.
+        """
+        codes, column = {'host': (self._hosts, self._host),
+                         'domain': (self._domains, self._domain)}[name]
+        code = codes.get(value)
+        if code is None:
+            return numpy.zeros(len(self), dtype=bool)
+        return column == code
+
+
+def _parse(expr):
+    try:
+        return ast.parse(expr, '<placement>', 'eval').body
+    except SyntaxError:
+        raise NotVectorizable(expr)
+
+
+def vectorize_requirement(expr):
+    """Return a function that evaluates the requirement C{expr} over
+    a L{Fleet} into a boolean array.
+    """
+    if numpy is None:
+        raise NotVectorizable(expr)
+    return _requirement(_parse(expr))
+
+
+def _constant_bool(value):
+    return lambda fleet: numpy.repeat(value, len(fleet))
+
+
+def _requirement(node):
+    if isinstance(node, ast.BoolOp):
+        parts = [_requirement(value) for value in node.values]
+        op = (numpy.logical_and if isinstance(node.op, ast.And)
+              else numpy.logical_or)
+        return lambda fleet: reduce(op, [part(fleet) for part in parts])
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        inner = _requirement(node.operand)
+        return lambda fleet: ~inner(fleet)
+    if isinstance(node, ast.Name) and node.id in ('True', 'False'):
+        return _constant_bool(node.id == 'True')
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        return _comparison(node.left, node.ops[0], node.comparators[0])
+    raise NotVectorizable(ast.dump(node))
+
+
+def _comparison(left, op, right):
+    if isinstance(op, (ast.In, ast.NotIn)):
+        if (isinstance(left, ast.Str) and isinstance(right, ast.Name)
+                and right.id == 'tags'):
+            tag = left.s
+            if isinstance(op, ast.In):
+                return lambda fleet: fleet.has_tag(tag)
+            return lambda fleet: ~fleet.has_tag(tag)
+    elif isinstance(op, (ast.Eq, ast.NotEq)):
+        if isinstance(left, ast.Str):
+            left, right = right, left
+        if (isinstance(left, ast.Name) and left.id in ('host', 'domain')
+                and isinstance(right, ast.Str)):
+            name, value = left.id, right.s
+            if isinstance(op, ast.Eq):
+                return lambda fleet: fleet.equals(name, value)
+            return lambda fleet: ~fleet.equals(name, value)
+    raise NotVectorizable(op.__class__.__name__)
+
+
+def vectorize_rank(expr):
+    """Return a function that evaluates the linear rank expression
+    C{expr} over a L{Fleet} into a float array.
+    """
+    if numpy is None:
+        raise NotVectorizable(expr)
+    fn, _constant = _linear(_parse(expr))
+    return lambda fleet: fn(fleet) + numpy.zeros(len(fleet))
+
+
+# division is left out since the per-executor path does integer
+# division on integer operands.
+_BINOPS = {ast.Add: operator.add, ast.Sub: operator.sub,
+           ast.Mult: operator.mul}
+
+
+def _linear(node):
+    """Translate C{node} into a function of the fleet.
+
+    Returns the function and whether it is a constant.  Products are
+    only allowed with a constant factor so that the expression stays
+    linear.
+    """
+    if isinstance(node, ast.Num):
+        value = float(node.n)
+        return (lambda fleet: value), True
+    if isinstance(node, ast.Name):
+        if node.id == 'ncont':
+            return (lambda fleet: fleet.ncont), False
+        if node.id == 'health':
+            return (lambda fleet: fleet.health), False
+        if node.id in _RESOURCES:
+            resource = node.id
+            return (lambda fleet: fleet.capacity(resource)), False
+    elif isinstance(node, ast.UnaryOp) and isinstance(
+            node.op, (ast.USub, ast.UAdd)):
+        inner, constant = _linear(node.operand)
+        if isinstance(node.op, ast.UAdd):
+            return inner, constant
+        return (lambda fleet: -inner(fleet)), constant
+    elif isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        op = _BINOPS[type(node.op)]
+        left, left_constant = _linear(node.left)
+        right, right_constant = _linear(node.right)
+        if isinstance(node.op, ast.Mult) and not (
+                left_constant or right_constant):
+            raise NotVectorizable("non-linear product")
+        return ((lambda fleet: op(left(fleet), right(fleet))),
+                left_constant and right_constant)
+    raise NotVectorizable(ast.dump(node))
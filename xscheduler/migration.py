@@ -0,0 +1,253 @@
+# Copyright 2013 Johan Rydberg.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rolling migrations of instances to a new release.
+
+A migration is requested by storing a record in the
+L{MigrationStore}.  The L{Migrator} runs on the leader and moves the
+instances over in waves, writing its progress back to the record.
+"""
+
+from collections import defaultdict
+import json
+import logging
+
+from etcd import EtcdError
+
+from .release import DependencyError, FormationStore
+from .util import RecurringTask
+
+
+STATE_PENDING = 'pending'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+ACTIVE_STATES = (STATE_PENDING, STATE_RUNNING)
+
+
+def new_migration(from_name=None, batch_size=10, max_unavailable=None):
+    """Return the record of a migration that has not started yet.
+
+    @param batch_size: Number of instances restarted per wave.
+    @param max_unavailable: Number of instances of a service that may
+        be down at the same time, defaults to C{batch_size}.
+    """
+    return {'state': STATE_PENDING, 'from': from_name,
+            'batch_size': batch_size,
+            'max_unavailable': (max_unavailable if max_unavailable
+                                is not None else batch_size),
+            'total': None, 'migrated': 0, 'waves': 0, 'services': [],
+            'in_flight': [], 'wave_started': None, 'error': None}
+
+
+class _MigrationArchive(FormationStore):
+    PREFIX = 'migration-archive'
+
+
+class MigrationStore(FormationStore):
+    """Migration records.
+
+    Records of migrations that are pending or running are kept under
+    PREFIX, and are moved to an archive when the migration is done or
+    has failed, so that the L{Migrator} only reads the active ones.
+    """
+    PREFIX = 'migration'
+
+    def __init__(self, etcd):
+        FormationStore.__init__(self, etcd)
+        self._archive = _MigrationArchive(etcd)
+
+    def get(self, formation, name):
+        """Return the latest migration to release C{name}, active or
+        archived.
+        """
+        data = FormationStore.get(self, formation, name)
+        if data is None:
+            data = self._archive.get(formation, name)
+        return data
+
+    def set(self, formation, name, data):
+        if data.get('state') in ACTIVE_STATES:
+            self.etcd.set(self._make_key(formation, name), json.dumps(data))
+            return
+        self.etcd.set(self._archive._make_key(formation, name),
+                      json.dumps(data))
+        try:
+            self.delete(formation, name)
+        except EtcdError:
+            pass
+
+    def index(self):
+        """Yield C{(formation, name, data)} for every active
+        migration.
+        """
+        return self._records()
+
+
+class Migrator(object):
+    """Process that rolls releases out in waves.
+
+    Instances whose spec does not change are moved to the release
+    right away.  The others are migrated a dependency level at a
+    time, see L{Release.dependency_levels}.  The services of a level
+    are migrated side by side, each at most C{batch_size} instances
+    per wave and never with more than C{max_unavailable} instances
+    down at once.  A wave is done when all of its instances are
+    running according to both the store and the state cache, and the
+    next level is only started when the one before it is done.  A
+    wave that is not done within WAVE_TIMEOUT seconds fails the
+    migration.
+    """
+    log = logging.getLogger('scheduler.migrator')
+
+    INTERVAL = 2
+    WAVE_TIMEOUT = 10 * 60
+
+    def __init__(self, clock, store_query, state_cache, release_store,
+                 migration_store, release_factory):
+        self._runner = RecurringTask(self.INTERVAL, self._do_migrate)
+        self.clock = clock
+        self.store_query = store_query
+        self.state_cache = state_cache
+        self.release_store = release_store
+        self.migration_store = migration_store
+        self.release_factory = release_factory
+        self.start = self._runner.start
+        self.stop = self._runner.stop
+
+    def _do_migrate(self):
+        for formation, name, migration in list(self.migration_store.index()):
+            if migration.get('state') not in ACTIVE_STATES:
+                # left behind by an earlier failure to archive it.
+                self.migration_store.set(formation, name, migration)
+                continue
+            try:
+                updated = self._advance(formation, name, dict(migration))
+                if updated != migration:
+                    self.migration_store.set(formation, name, updated)
+            except Exception:
+                self.log.exception("cannot advance migration of %s:%s" % (
+                        formation, name))
+
+    def _advance(self, formation, name, migration):
+        """Take the next step of C{migration} and return the updated
+        record.
+        """
+        data = self.release_store.get(formation, name)
+        if data is None:
+            return self._fail(migration, "release does not exist")
+        release = self.release_factory(formation, name, data['services'])
+        now = self.clock.time()
+        try:
+            plan = release.migration_plan(migration['from'])
+        except DependencyError, err:
+            return self._fail(migration, str(err))
+
+        in_flight = self._instances(formation, migration['in_flight'])
+        if not self._healthy(in_flight):
+            if now - migration['wave_started'] > self.WAVE_TIMEOUT:
+                return self._fail(migration, "wave did not become healthy")
+            return migration
+        migration['in_flight'] = []
+
+        if migration['state'] == STATE_PENDING:
+            migration['state'] = STATE_RUNNING
+            migration['total'] = sum(len(insts) for level in plan
+                                     for (_, insts) in level)
+            migration['wave_started'] = now
+
+        for level in plan:
+            restart = []
+            for service, insts in level:
+                for inst in insts:
+                    if release.needs_restart(inst):
+                        restart.append(inst)
+                    else:
+                        release.migrate_instance(inst)
+                        migration['migrated'] += 1
+            if restart:
+                return self._start_wave(migration, release, restart, now)
+
+        self.log.info("migration of %s:%s done" % (formation, name))
+        migration.update(state=STATE_DONE, services=[])
+        return migration
+
+    def _start_wave(self, migration, release, insts, now):
+        """Migrate the next wave of C{insts}, which are the instances
+        of a dependency level that have to be restarted.
+        """
+        per_service = defaultdict(list)
+        for inst in insts:
+            per_service[inst.service].append(inst)
+        wave = []
+        for service, candidates in sorted(per_service.items()):
+            down = len([inst for (inst, healthy) in self._health(
+                        self.store_query.query_service(release.formation,
+                                                       service))
+                        if not healthy])
+            size = min(migration['batch_size'],
+                       migration['max_unavailable'] - down)
+            wave.extend(candidates[:max(size, 0)])
+        if not wave:
+            if now - migration['wave_started'] > self.WAVE_TIMEOUT:
+                return self._fail(migration, "too many unavailable "
+                                  "instances of %s" % (
+                        ', '.join(sorted(per_service)),))
+            return migration
+        self.log.info("migrating %d instances of %s:%s" % (
+                len(wave), release.formation,
+                ', '.join(sorted(per_service))))
+        for inst in wave:
+            release.migrate_instance(inst)
+        migration['migrated'] += len(wave)
+        migration['waves'] += 1
+        migration['services'] = sorted(per_service)
+        migration['in_flight'] = [[inst.service, inst.instance]
+                                  for inst in wave]
+        migration['wave_started'] = now
+        return migration
+
+    def _fail(self, migration, error):
+        self.log.error("migration failed: %s" % (error,))
+        migration.update(state=STATE_FAILED, error=error)
+        return migration
+
+    def _instances(self, formation, names):
+        """Return the instances named by C{names} that still exist and
+        have not been shut down.
+        """
+        insts = [self.store_query.get(formation, service, instance)
+                 for (service, instance) in names]
+        return [inst for inst in insts if inst is not None
+                and inst.state != inst.STATE_SHUTTING_DOWN
+                and inst.state != inst.STATE_TERMINATED]
+
+    def _health(self, insts):
+        """Return C{(instance, healthy)} pairs, where an instance is
+        healthy if it is running according to both the store and the
+        state cache.
+        """
+        insts = [inst for inst in insts
+                 if inst.state != inst.STATE_SHUTTING_DOWN
+                 and inst.state != inst.STATE_TERMINATED]
+        statuses = self.state_cache.get_many(
+            [(inst.formation, inst.service, inst.instance)
+             for inst in insts])
+        return [(inst, inst.state == inst.STATE_RUNNING
+                 and status.get('state') == 'running')
+                for (inst, status) in zip(insts, statuses)]
+
+    def _healthy(self, insts):
+        return all(healthy for (_, healthy) in self._health(insts))
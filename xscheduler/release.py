@@ -13,11 +13,13 @@
 # limitations under the License.
 
 from collections import defaultdict
+from functools import partial
 import json
 import random
 import logging
 
 from etcd import EtcdError
+from gevent.pool import Pool
 
 from . import store
 
@@ -27,7 +29,43 @@ def _is_running(inst):
             inst.state == inst.STATE_MIGRATING)
 
 
+class ReleaseError(Exception):
+    """The services of a release cannot be used."""
+
+
+class DependencyError(ReleaseError):
+    """The services of a release have circular requirements."""
+
+
+def check_services(services):
+    """Check the shape of the services of a release.
+
+    Services are given as an object that maps service names to
+    templates.  A template must have an C{image}, and its C{env},
+    C{ports} and C{requires} must be an object and lists if given.
+
+    @raise ReleaseError: If the services cannot be used.
+    """
+    if not isinstance(services, dict):
+        raise ReleaseError("services must be an object")
+    for name, template in services.iteritems():
+        if not isinstance(template, dict):
+            raise ReleaseError("service %s must be an object" % (name,))
+        if not isinstance(template.get('image'), basestring):
+            raise ReleaseError("service %s has no image" % (name,))
+        for field, kind, what in (('env', dict, 'an object'),
+                                  ('ports', list, 'a list'),
+                                  ('requires', list, 'a list')):
+            if not isinstance(template.get(field, kind()), kind):
+                raise ReleaseError("%s of service %s must be %s" % (
+                        field, name, what))
+
+
 class Release(object):
+    # at most this many instances are created or shut down per call to
+    # scale, and this many store writes are made at the same time.
+    MAX_SCALE_CHANGES = 1000
+    WRITE_CONCURRENCY = 20
 
     def __init__(self, store_command, store_query,
                  formation, name, services):
@@ -37,6 +75,11 @@ class Release(object):
         self.formation = formation
         self.name = name
         self.services = services
+        self._fingerprints = dict(
+            (service, store.spec_fingerprint(
+                    template['image'], template.get('command'),
+                    template.get('env', {}), template.get('ports', [])))
+            for (service, template) in services.items())
 
     def _create(self, service):
         """Create an instance of service."""
@@ -47,13 +90,15 @@ class Release(object):
                             template['image'],
                             template.get('command'),
                             env=template.get('env', {}),
-                            ports=template.get('ports', []))
+                            ports=template.get('ports', []),
+                            resources=template.get('resources'))
 
     def _collect(self, release=None):
-        return [inst for inst in self.store_query.index()
-                if inst.formation == self.formation
-                and (release is None or release == inst.release)
-                and _is_running(inst)]
+        if release is None:
+            insts = self.store_query.query_formation(self.formation)
+        else:
+            insts = self.store_query.query_release(self.formation, release)
+        return [inst for inst in insts if _is_running(inst)]
 
     def _group(self, insts):
         groups = defaultdict(list)
@@ -61,81 +106,127 @@ class Release(object):
             groups[inst.service].append(inst)
         return groups
 
-    def scale(self, scales):
+    def scale(self, scales, limit=None):
         """Scale this release.
 
-        Return true if there might be more to do to meet the scale.
+        The instances to create and shut down are worked out for
+        every service in C{scales} and the changes are made in one
+        go, at most C{limit} of them (MAX_SCALE_CHANGES by default).
+        Instances that are not running yet are shut down first.
+
+        Return true if there is more to do to meet the scale.
         """
-        insts = [inst for inst in self.store_query.index()
-                 if inst.formation == self.formation
-                 and inst.release == self.name
-                 and _is_running(inst)]
-        per_service = defaultdict(list)
-        for inst in insts:
-            per_service[inst.service].append(inst)
+        if limit is None:
+            limit = self.MAX_SCALE_CHANGES
+        per_service = self._group(self._collect(self.name))
+        changes = []
         for name, scale in scales.items():
             insts = per_service.get(name, [])
             if len(insts) > scale:
-                random.choice(insts).shutdown()
-                return True
+                insts.sort(key=lambda inst: (
+                        inst.state == inst.STATE_RUNNING, random.random()))
+                changes.extend(inst.shutdown
+                               for inst in insts[:len(insts) - scale])
             elif len(insts) < scale:
-                # we need to create an instance
-                self._create(name)
-                return True
+                changes.extend(partial(self._create, name)
+                               for _ in range(scale - len(insts)))
+        self.log.info("scale: %d changes, limit %d" % (len(changes), limit))
+        pool = Pool(self.WRITE_CONCURRENCY)
+        list(pool.imap_unordered(lambda change: change(), changes[:limit]))
+        return len(changes) > limit
 
-    def migrate(self, from_name=None):
-        """Migrate existing instances to the given release.
+    def migration_plan(self, from_name=None):
+        """Return the instances that are not part of this release yet.
 
-        Returns true if there might be more instances to migrate.
+        The instances are returned per dependency level, see
+        L{dependency_levels}, as lists of C{(service, instances)}
+        pairs.
         """
-        inst_map = dict(self._group(self._collect(from_name)))
-        return self._migrate_to_release(inst_map)
-
-    def _compare_instance_to_service(self, inst, service):
-        inst_env = inst.env or {}
-        serv_env = service['env'] or {}
-        inst_ports = inst.ports or []
-        serv_ports = service['ports'] or []
-        return (inst.image == service['image']
-                and inst.command == service['command']
-                and inst_env == serv_env
-                and inst_ports == serv_ports)
-
-    def _migrate_to_release(self, inst_map):
-        insts = [inst
-                 for name in self._build_order()
-                 for inst in inst_map.get(name, [])]
-        insts = [inst for inst in insts
-                 if inst.release != self.name]
-        cnt = len(insts)
-        self.log.info("instances to migrate: %d" % (cnt,))
-        for inst in insts:
-            service = self.services[inst.service]
-            if self._compare_instance_to_service(inst, service):
-                self.log.info("re-release %s" % (inst.name,))
-                inst.rerelease(self.name)
-            else:
-                self.log.info("migrate %s" % (inst.name,))
-                inst.migrate(self.name, service['image'],
-                             service['command'],
-                             service.get('env', {}),
-                             service.get('ports', []))
-            return cnt > 1
-
-    def _build_order(self):
-        order = self.services.keys()
+        inst_map = self._group(self._collect(from_name))
+        return [[(name, [inst for inst in inst_map.get(name, [])
+                         if inst.release != self.name])
+                 for name in level]
+                for level in self.dependency_levels()]
+
+    def _spec_changed(self, inst):
+        return (inst.fingerprint != self._fingerprints[inst.service]
+                or inst.resources != self.services[inst.service].get(
+                    'resources'))
+
+    def needs_restart(self, inst):
+        """Return true if C{inst} has to be restarted to be moved to
+        this release.
+
+        Pending instances have not been started yet, so they never
+        have to be restarted.
+        """
+        return (inst.state != inst.STATE_PENDING
+                and self._spec_changed(inst))
+
+    def migrate_instance(self, inst):
+        """Move C{inst} to this release.
+
+        A pending instance gets the spec of this release but stays
+        pending, so that the scheduler starts it as usual.
+        """
+        service = self.services[inst.service]
+        if not self._spec_changed(inst):
+            self.log.info("re-release %s" % (inst.name,))
+            inst.rerelease(self.name)
+            return
+        self.log.info("migrate %s" % (inst.name,))
+        state = (inst.STATE_PENDING if inst.state == inst.STATE_PENDING
+                 else inst.STATE_MIGRATING)
+        inst.migrate(self.name, service['image'],
+                     service['command'],
+                     service.get('env', {}),
+                     service.get('ports', []),
+                     service.get('resources'), state)
+
+    def dependency_levels(self):
+        """Group the services by their requirements.
+
+        Services only require services in earlier levels, so the
+        services of a level can be migrated at the same time once the
+        levels before it are done.  Requirements on services that are
+        not part of the release are ignored.
+
+        @raise DependencyError: If there are circular requirements.
+        """
+        waiting = {}
+        dependents = defaultdict(list)
         for name, defn in self.services.items():
-            requires = defn.get('requires', [])
+            requires = set(require for require in defn.get('requires', [])
+                           if require in self.services)
+            waiting[name] = len(requires)
             for require in requires:
-                idx = order.index(require)
-                if idx < order.index(name):
-                    order.remove(name)
-                    order.insert(idx, name)
-        return reversed(order)
+                dependents[require].append(name)
 
+        levels = []
+        level = sorted(name for (name, count) in waiting.items()
+                       if not count)
+        while level:
+            levels.append(level)
+            ready = []
+            for name in level:
+                for dependent in dependents[name]:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+            level = sorted(ready)
 
-class ReleaseStore(object):
-    PREFIX = 'release'
+        blocked = sorted(name for (name, count) in waiting.items() if count)
+        if blocked:
+            raise DependencyError("circular requirements involving %s" % (
+                    ', '.join(blocked),))
+        return levels
+
+
+class FormationStore(object):
+    """Common code for stores of JSON records keyed by formation and
+    name under PREFIX.
+    """
+    PREFIX = None
 
     def __init__(self, etcd):
         self.etcd = etcd
@@ -156,23 +247,35 @@ class ReleaseStore(object):
         else:
             return json.loads(result.value)
 
-    def create(self, formation, name, data):
-        try:
-            return self.etcd.testandset(
-                self._make_key(formation, name), '', json.dumps(data))
-        except EtcdError:
-            raise Exception("already there.")
-
     def delete(self, formation, name):
         self.etcd.delete(self._make_key(formation, name))
 
-    def index(self, formation):
-        indexkey = '%s/%s' % (self.PREFIX, formation)
+    def _records(self, formation=None):
+        """Yield C{(formation, name, data)} for the records of
+        C{formation}, or of all formations if it is C{None}.
+        """
+        indexkey = (self.PREFIX if formation is None
+                    else '%s/%s' % (self.PREFIX, formation))
         try:
             for key, value in self.etcd.get_recursive(indexkey).items():
                 formation, name = self._split_key(key)
-                yield name, json.loads(value)
+                yield formation, name, json.loads(value)
         except ValueError:
             pass
         except EtcdError:
             pass
+
+
+class ReleaseStore(FormationStore):
+    PREFIX = 'release'
+
+    def create(self, formation, name, data):
+        try:
+            return self.etcd.testandset(
+                self._make_key(formation, name), '', json.dumps(data))
+        except EtcdError:
+            raise Exception("already there.")
+
+    def index(self, formation):
+        for _formation, name, data in self._records(formation):
+            yield name, data
@@ -12,13 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict
+import ast
+import heapq
 import logging
 
+from gevent.lock import Semaphore
+import gevent
+
 from .executor import DispatchError
-from .util import RecurringTask, TokenBucketRateLimiter
+from .fleet import (Fleet, NotVectorizable, numpy, vectorize_rank,
+                    vectorize_requirement)
+from .util import LRUCache, RecurringTask, TokenBucketRateLimiter
 
 
-_DEFAULT_RANK = '-ncont'
+# spread instances, but keep them away from executors that are slow
+# or failing.
+_DEFAULT_RANK = '100 * health - ncont'
 
 
 def _is_running(inst):
@@ -27,115 +37,604 @@ def _is_running(inst):
             inst.state == inst.STATE_MIGRATING)
 
 
+class PlacementError(Exception):
+    """Raised when placement options cannot be used."""
+
+
+class _ExpressionCompiler(object):
+    """Compiles placement expressions into code objects.
+
+    Expressions are checked against a whitelist of syntax nodes and
+    names before they are compiled, and compiled code is kept in a
+    bounded LRU cache so that each distinct expression is only parsed
+    once.
+    """
+
+    NODES = (
+        ast.Expression, ast.Load,
+        ast.BoolOp, ast.And, ast.Or,
+        ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+        ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod,
+        ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt,
+        ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+        ast.IfExp, ast.Name, ast.Num, ast.Str, ast.List, ast.Tuple)
+
+    CONSTANTS = ('True', 'False', 'None')
+
+    def __init__(self, names, maxsize=256):
+        self.names = frozenset(names) | frozenset(self.CONSTANTS)
+        self._cache = LRUCache(maxsize)
+
+    def compile(self, expr):
+        if not isinstance(expr, basestring):
+            raise PlacementError("%r: not an expression" % (expr,))
+        code = self._cache.get(expr)
+        if code is None:
+            code = self._compile(expr)
+            self._cache.put(expr, code)
+        return code
+
+    def _compile(self, expr):
+        try:
+            tree = ast.parse(expr, '<placement>', 'eval')
+        except SyntaxError, err:
+            raise PlacementError("%r: %s" % (expr, err))
+        for node in ast.walk(tree):
+            if not isinstance(node, self.NODES):
+                raise PlacementError("%r: %s not allowed" % (
+                        expr, node.__class__.__name__))
+            if isinstance(node, ast.Name) and node.id not in self.names:
+                raise PlacementError("%r: unknown name %s" % (
+                        expr, node.id))
+        return compile(tree, '<placement>', 'eval')
+
+
+def _evaluate(code, vars):
+    """Evaluate a compiled placement expression with C{vars}.
+
+    @raise PlacementError: If the evaluation fails, for example with
+        a division by zero or a comparison against a missing value.
+    """
+    try:
+        return eval(code, vars, {})
+    except Exception, err:
+        raise PlacementError("cannot evaluate expression: %s: %s" % (
+                err.__class__.__name__, err))
+
+
+def check_placement(placement):
+    """Check that the placement options of an instance can be used.
+
+    Expressions are limited to the syntax and names that the
+    placement policies accept; function calls and attribute access
+    are not allowed.
+
+    @raise PlacementError: If they cannot.
+    """
+    placement = placement or {}
+    requirements = placement.get('requirements', [])
+    if not isinstance(requirements, list):
+        raise PlacementError("requirements must be a list")
+    compiler = _ExpressionCompiler(
+        RequirementRankPlacementPolicy.REQUIREMENT_NAMES)
+    for requirement in requirements:
+        compiler.compile(requirement)
+    if placement.get('rank') is not None:
+        _ExpressionCompiler(
+            RequirementRankPlacementPolicy.RANK_NAMES).compile(
+            placement['rank'])
+
+
+def check_resources(resources):
+    """Check that the resources requested by an instance can be used.
+
+    Resources are given as an object that maps C{cpu} and C{memory} to
+    non-negative numbers.
+
+    @raise PlacementError: If they cannot.
+    """
+    if resources is None:
+        return
+    if not isinstance(resources, dict):
+        raise PlacementError("resources must be an object")
+    for resource, amount in resources.iteritems():
+        if resource not in _RESOURCES:
+            raise PlacementError("unknown resource %r" % (resource,))
+        if (isinstance(amount, bool)
+                or not isinstance(amount, (int, long, float))
+                or not 0 <= amount < float('inf')):
+            raise PlacementError("%s must be a non-negative number" % (
+                    resource,))
+
+
 class RequirementRankPlacementPolicy(object):
+    """Place instances on executors that match all requirements of
+    the instance, preferring executors with the highest rank.
+
+    Executors with an open circuit are never selected.  The rank
+    expression can use C{health}, the health score of the executor,
+    to steer instances away from slow or failing executors.
+    """
+    log = logging.getLogger('scheduler.policy')
+
+    REQUIREMENT_NAMES = ('tags', 'host', 'domain')
+    RANK_NAMES = ('ncont', 'cpu', 'memory', 'health')
+
+    # with at least this many executors, expressions are evaluated
+    # over the whole fleet with NumPy when possible.
+    VECTORIZE_THRESHOLD = 64
+
+    def __init__(self):
+        self._requirements = _ExpressionCompiler(self.REQUIREMENT_NAMES)
+        self._ranks = _ExpressionCompiler(self.RANK_NAMES)
+        self._vectors = LRUCache(256)
+        self._last_fleet = None
 
     def select(self, executors, options):
         """Given a set of executors and placement options, select a
         executor where the instance should be placed.
         """
+        executors = list(executors)
+        fleet = self._fleet(executors)
+        if fleet is not None:
+            mask = self._vector_requirements(options)
+            rank = self._vector(vectorize_rank,
+                                options.get('rank') or _DEFAULT_RANK)
+            if mask is not None and rank is not None:
+                ranks = numpy.where(mask(fleet) & fleet.available,
+                                    rank(fleet), -numpy.inf)
+                index = numpy.argmax(ranks)
+                return (executors[index] if ranks[index] > -numpy.inf
+                        else None)
+            code = self._ranks.compile(options.get('rank') or _DEFAULT_RANK)
+            candidates = self._candidates(executors, options, fleet)
+            if not candidates:
+                return None
+            _index, executor = max(candidates, key=lambda candidate: _evaluate(
+                    code, fleet.rank_vars(candidate[0])))
+            return executor
         e = self._rank_executors(
                 self._filter_out_executors_that_do_not_match_requirements(
                     executors, options), options)
         return next(iter(e), None)
 
-    def _eval_requirement(self, requirement, executor):
-        vars = {'tags': executor.tags, 'host': executor.host,
+    def _fleet(self, executors):
+        """Return a L{Fleet} for C{executors}, reusing the previous one
+        if the set of executors has not changed.
+        """
+        if numpy is None or len(executors) < self.VECTORIZE_THRESHOLD:
+            return None
+        fleet = self._last_fleet
+        if fleet is not None and fleet.executors == executors:
+            fleet.refresh()
+        else:
+            if fleet is not None:
+                fleet.close()
+            fleet = self._last_fleet = Fleet(executors)
+        return fleet
+
+    def _vector(self, vectorize, expr):
+        """Return the vectorized form of C{expr}, or C{None} if it
+        cannot be vectorized.
+        """
+        key = (vectorize, expr)
+        fn = self._vectors.get(key)
+        if fn is None:
+            try:
+                fn = vectorize(expr)
+            except NotVectorizable:
+                fn = False
+            self._vectors.put(key, fn)
+        return fn or None
+
+    def _vector_requirements(self, options):
+        requirements = options.get('requirements', [])
+        for requirement in requirements:
+            # validates the requirement.
+            self._requirements.compile(requirement)
+        fns = [self._vector(vectorize_requirement, requirement)
+               for requirement in requirements]
+        if None in fns:
+            return None
+        return lambda fleet: reduce(
+            numpy.logical_and, [fn(fleet) for fn in fns],
+            numpy.ones(len(fleet), dtype=bool))
+
+    def place(self, executors, instances):
+        """Place a batch of instances.
+
+        Return a list of C{(instance, executor)} pairs, where executor
+        is C{None} if no executor matched the requirements.  The load
+        of an executor is updated as instances are assigned to it, so
+        that a burst of instances is spread according to the rank.
+        Instances with placement options that are invalid or that fail
+        to evaluate are logged and left out of the result.
+        """
+        executors = list(executors)
+        fleet = self._fleet(executors)
+        load = self._initial_load(executors)
+        groups = OrderedDict()
+        for instance in instances:
+            groups.setdefault(self._group_key(instance), []).append(instance)
+
+        placements = []
+        for group in groups.itervalues():
+            options = group[0].placement or {}
+            try:
+                placements.extend(self._place_group(
+                        executors, options, group, load, fleet))
+            except PlacementError, err:
+                self.log.error("cannot place %s: %s" % (
+                        ', '.join(inst.name for inst in group), err))
+        return placements
+
+    def _initial_load(self, executors):
+        """Return the per-pass load bookkeeping for C{executors}; here
+        the number of instances assigned to each executor.
+        """
+        return dict((executor.name, 0) for executor in executors)
+
+    def _group_key(self, instance):
+        """Return a key that is equal for instances that can be placed
+        as a group.
+        """
+        options = instance.placement or {}
+        return (tuple(options.get('requirements', [])),
+                options.get('rank'))
+
+    def _place_group(self, executors, options, instances, assigned,
+                     fleet=None):
+        expr = options.get('rank') or _DEFAULT_RANK
+        code = self._ranks.compile(expr)
+        if fleet is not None:
+            rank = lambda index, executor: _evaluate(
+                code, fleet.rank_vars(index))
+        else:
+            rank = lambda index, executor: _evaluate(code, self._collect_vars(
+                    executor, assigned[executor.name]))
+        candidates = self._candidates(executors, options, fleet)
+        vector = (self._vector(vectorize_rank, expr)
+                  if fleet is not None else None)
+        if vector is not None:
+            ranks = vector(fleet)
+            heap = [(-ranks[index], index, executor)
+                    for (index, executor) in candidates]
+        else:
+            # the index breaks ties so that executors are never compared.
+            heap = [(-rank(index, executor), index, executor)
+                    for (index, executor) in candidates]
+        heapq.heapify(heap)
+        for instance in instances:
+            if not heap:
+                yield instance, None
+                continue
+            _rank, index, executor = heap[0]
+            assigned[executor.name] += 1
+            if fleet is not None:
+                fleet.assigned[index] += 1
+            heapq.heapreplace(heap, (-rank(index, executor), index,
+                                     executor))
+            yield instance, executor
+
+    def _candidates(self, executors, options, fleet=None):
+        """Return C{(index, executor)} pairs for the executors that
+        match all requirements in C{options}.
+        """
+        if fleet is not None:
+            mask = self._vector_requirements(options)
+            if mask is not None:
+                return [(index, executors[index]) for index
+                        in numpy.flatnonzero(mask(fleet) & fleet.available)]
+        requirements = options.get('requirements', [])
+        codes = [self._requirements.compile(requirement)
+                 for requirement in requirements]
+        return [(index, executor) for (index, executor) in enumerate(executors)
+                if executor.available()
+                and self._match_requirements(codes, executor)]
+
+    def _requirement_vars(self, executor):
+        return {'tags': executor.tags, 'host': executor.host,
                 'domain': executor.domain}
-        return eval(requirement, vars, {})
 
     def _filter_out_executors_that_do_not_match_requirements(
             self, executors, options):
-        requirements = options.get('requirements', [])
-        if not requirements:
-            return executors
-        return [
-            executor
-            for requirement in requirements
-            for executor in executors
-            if self._eval_requirement(requirement, executor)]
+        return [executor for (index, executor)
+                in self._candidates(executors, options)]
+
+    def _match_requirements(self, codes, executor):
+        vars = self._requirement_vars(executor)
+        return all(_evaluate(code, vars) for code in codes)
 
-    def _collect_vars(self, executor):
-        """Collect rank variables."""
-        return {'ncont': len(executor.containers())}
+    def _collect_vars(self, executor, assigned=0):
+        """Collect rank variables.
 
-    def _eval_rank(self, rank, vars):
-        return eval(rank, vars, {})
+        @param assigned: Number of instances that have been assigned
+            to the executor but that it does not know about yet.
+        """
+        return {'ncont': executor.container_count() + assigned,
+                'cpu': executor.capacity.get('cpu', 0),
+                'memory': executor.capacity.get('memory', 0),
+                'health': executor.health()}
 
     def _rank_executors(self, executors, options):
-        rank = options.get('rank') or _DEFAULT_RANK
-        executors.sort(key=lambda executor: self._eval_rank(rank,
-            self._collect_vars(executor)))
+        code = self._ranks.compile(options.get('rank') or _DEFAULT_RANK)
+        executors.sort(key=lambda executor: _evaluate(
+                code, self._collect_vars(executor)), reverse=True)
         return executors
 
 
+_RESOURCES = ('cpu', 'memory')
+
+
+def _requested(instance):
+    """Return the resources requested by C{instance} as a tuple
+    ordered like C{_RESOURCES}.
+
+    @raise PlacementError: If the resources cannot be used.
+    """
+    check_resources(instance.resources)
+    resources = instance.resources or {}
+    return tuple(resources.get(resource, 0) for resource in _RESOURCES)
+
+
+class BinPackPlacementPolicy(RequirementRankPlacementPolicy):
+    """Place instances according to the resources that they request
+    and the capacity that executors advertise.
+
+    With best fit an instance goes to the executor that has the least
+    capacity left after the placement, packing instances onto as few
+    executors as possible.  With worst fit it goes to the executor
+    with the most capacity left, spreading the load.  Executors that
+    do not advertise a capacity for a resource are treated as having
+    plenty of it.  Instances are never placed on an executor that
+    cannot fit them.  Requirements are honored, but the rank option
+    is not used.
+    """
+    BEST_FIT = 'best-fit'
+    WORST_FIT = 'worst-fit'
+
+    def __init__(self, fit=BEST_FIT):
+        if fit not in (self.BEST_FIT, self.WORST_FIT):
+            raise ValueError("unknown fit %r, expected %s or %s" % (
+                    fit, self.BEST_FIT, self.WORST_FIT))
+        RequirementRankPlacementPolicy.__init__(self)
+        self.fit = fit
+
+    def _initial_load(self, executors):
+        """Return the free capacity of each executor."""
+        load = {}
+        for executor in executors:
+            allocated = executor.allocated()
+            load[executor.name] = [
+                executor.capacity[resource] - allocated.get(resource, 0)
+                if resource in executor.capacity else None
+                for resource in _RESOURCES]
+        return load
+
+    def _group_key(self, instance):
+        try:
+            requested = _requested(instance)
+        except PlacementError:
+            # a group of its own, which is rejected when it is placed.
+            requested = instance.name
+        return (RequirementRankPlacementPolicy._group_key(self, instance),
+                requested)
+
+    def _score(self, executor, free, requested):
+        """Return the score of placing C{requested} on executor, lower
+        is better, or C{None} if it does not fit.
+        """
+        left = []
+        for resource, amount, available in zip(
+                _RESOURCES, requested, free):
+            if available is None:
+                left.append(1.0)
+                continue
+            if amount > available:
+                return None
+            capacity = executor.capacity[resource]
+            left.append((available - amount) / float(capacity)
+                        if capacity else 0.0)
+        score = sum(left) / len(left)
+        return score if self.fit == self.BEST_FIT else -score
+
+    def _place_group(self, executors, options, instances, free,
+                     fleet=None):
+        requested = _requested(instances[0])
+        heap = []
+        for index, executor in self._candidates(executors, options, fleet):
+            score = self._score(executor, free[executor.name], requested)
+            if score is not None:
+                heap.append((score, index, executor))
+        heapq.heapify(heap)
+        for instance in instances:
+            if not heap:
+                yield instance, None
+                continue
+            _score, index, executor = heap[0]
+            available = free[executor.name]
+            for i, amount in enumerate(requested):
+                if available[i] is not None:
+                    available[i] -= amount
+            score = self._score(executor, available, requested)
+            if score is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (score, index, executor))
+            yield instance, executor
+
+
+# the loops below are woken up by store events; the interval is only
+# a safety net.  RETRY is used when a pass was cut short by the rate
+# limiter, and DEBOUNCE collapses a burst of events into one pass.
+_INTERVAL = 30
+_RETRY = 3
+_DEBOUNCE = 0.05
+
+
 class Scheduler(object):
+    log = logging.getLogger('scheduler.scheduler')
+
+    # dispatches are done concurrently, bounded both in total and per
+    # executor.  each dispatch is given DISPATCH_TIMEOUT seconds and
+    # carries at most DISPATCH_BATCH_SIZE instances to one executor.
+    DISPATCH_CONCURRENCY = 20
+    DISPATCH_BATCH_SIZE = 20
+    DISPATCH_PER_EXECUTOR = 4
+    DISPATCH_TIMEOUT = 60
 
-    def __init__(self, clock, store_query, manager, policy):
-        self._runner = RecurringTask(3, self._do_schedule)
+    def __init__(self, clock, store_query, manager, policy,
+                 dispatch_rate=100):
+        self._runner = RecurringTask(_INTERVAL, self._do_schedule,
+                                     _DEBOUNCE)
         self.clock = clock
         self.store_query = store_query
         self.manager = manager
         self.policy = policy
-        self._limiter = TokenBucketRateLimiter(clock, 10, 30)
+        self._limiter = TokenBucketRateLimiter(clock, dispatch_rate, 1)
+        self._slots = Semaphore(self.DISPATCH_CONCURRENCY)
+        self._executor_slots = {}
         self.start = self._runner.start
         self.stop = self._runner.stop
-        
+        self.store_query.on('create', self._handle_change)
+        self.store_query.on('update', self._handle_change)
+
+    def _handle_change(self, instance):
+        if (instance.state == instance.STATE_PENDING
+                or instance.state is None):
+            self._runner.touch()
+
     def _do_schedule(self):
+        batches = {}
+        unplaced = []
         for instance in self.store_query.unassigned():
             if not self._limiter.check():
+                self._runner.retry(_RETRY)
                 break
-            try:
-                if instance.assigned_to:
-                    instance.dispatch(self.manager, instance.assigned_to)
-                else:
-                    executor = self.policy.select(self.manager.clients(),
-                                                  instance.placement or {})
-                    if executor is not None:
-                        instance.dispatch(self.manager, executor.name)
-            except DispatchError:
-                print "error"
+            if instance.assigned_to:
+                batches.setdefault(instance.assigned_to, []).append(instance)
+            else:
+                unplaced.append(instance)
+        for instance, executor in self.policy.place(
+                self.manager.clients(), unplaced):
+            if executor is None:
+                self._runner.retry(_RETRY)
+                continue
+            batches.setdefault(executor.name, []).append(instance)
+        dispatches = []
+        for name, instances in batches.iteritems():
+            for batch in _chunks(instances, self.DISPATCH_BATCH_SIZE):
+                dispatches.append(gevent.spawn(self._dispatch, name, batch))
+        gevent.joinall(dispatches)
+
+    def _dispatch(self, name, instances):
+        slots = self._executor_slots.get(name)
+        if slots is None:
+            slots = self._executor_slots[name] = Semaphore(
+                self.DISPATCH_PER_EXECUTOR)
+        try:
+            with gevent.Timeout(self.DISPATCH_TIMEOUT,
+                                DispatchError("timeout")):
+                # take the executor slot first so that we never hold
+                # on to a global slot while waiting for a busy executor.
+                with slots:
+                    with self._slots:
+                        errors = self.manager.dispatch_many(instances, name)
+        except DispatchError, err:
+            errors = [err] * len(instances)
+        for instance, err in zip(instances, errors):
+            if err is None:
+                instance.update(state=instance.STATE_RUNNING,
+                                assigned_to=name)
+            else:
+                self.log.error("could not dispatch %s/%s to %s: %s" % (
+                        instance.formation, instance.name, name, err))
+                self._runner.retry(_RETRY)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class Updater(object):
+    """Process that restarts instances whose container no longer
+    matches the spec of the instance.
+
+    Only instances that have been updated, or whose container has
+    changed, since the last pass are checked.  All instances are
+    swept every SWEEP_INTERVAL seconds in case a change was missed.
+    """
     log = logging.getLogger('scheduler.updater')
 
+    SWEEP_INTERVAL = 5 * 60
+
     def __init__(self, clock, store_query, manager):
-        self._runner = RecurringTask(3, self._do_update)
+        self._runner = RecurringTask(self.SWEEP_INTERVAL, self._do_update,
+                                     _DEBOUNCE)
+        self.clock = clock
         self.store_query = store_query
         self.manager = manager
         self._limiter = TokenBucketRateLimiter(clock, 10, 30)
+        self._dirty = OrderedDict()
+        self._swept = None
         self.start = self._runner.start
         self.stop = self._runner.stop
+        self.store_query.on('update', self._handle_change)
+        self.manager.on('container', self._handle_container)
+
+    def _handle_change(self, instance):
+        # the spec of an instance only changes while it is running
+        # or being migrated to a new release.
+        if (instance.state == instance.STATE_RUNNING
+                or instance.state == instance.STATE_MIGRATING):
+            self._mark(instance)
+
+    def _handle_container(self, container):
+        instance = self.store_query.get(container.formation,
+                                        container.service,
+                                        container.instance)
+        if instance is not None:
+            self._mark(instance)
+
+    def _mark(self, instance):
+        self._dirty[(instance.formation, instance.name)] = instance
+        self._runner.touch()
 
     def _equal_instance_container(self, inst, cont):
-        inst_env = inst.env or {}
-        cont_env = cont.env or {}
-        inst_ports = inst.ports or []
-        cont_ports = cont.ports or []
-        return (inst.image == cont.image
-                and inst.command == cont.command
-                and inst_env == cont_env
-                and inst_ports == cont_ports)
+        return inst.fingerprint == cont.fingerprint
 
     def _do_update(self):
-        instances = list(self.store_query.index())
-        for instance, container in zip(
-                instances, self.manager.containers(instances)):
+        now = self.clock.time()
+        if self._swept is None or now - self._swept >= self.SWEEP_INTERVAL:
+            self._swept = now
+            self._dirty.clear()
+            instances = list(self.store_query.index())
+        else:
+            instances, self._dirty = self._dirty.values(), OrderedDict()
+        for index, (instance, container) in enumerate(zip(
+                instances, self.manager.containers(instances))):
             if container is None:
                 continue
             if not _is_running(instance):
                 continue
             if not self._equal_instance_container(instance, container):
-                if not self._limiter.check():
+                # migrations are paced by the migrator.
+                if (instance.state != instance.STATE_MIGRATING
+                        and not self._limiter.check()):
+                    self._postpone(instances[index:])
                     break
                 self.log.info("restarting %s/%s because of config change" % (
                         instance.formation, instance.name))
                 try:
                     instance.restart(self.manager)
-                except DispatchError:
-                    print "ERROR"
+                except DispatchError, err:
+                    self.log.error("could not restart %s/%s: %s" % (
+                            instance.formation, instance.name, err))
+                    self._postpone([instance])
             elif instance.state == instance.STATE_MIGRATING:
                 if not self._limiter.check():
+                    self._postpone(instances[index:])
                     break
                 # XXX: special case for instances that are stuck in
                 # migrating but migration has happened, but it has not
@@ -143,30 +642,60 @@ class Updater(object):
                 # outselves.
                 self.log.info("setting merging instance %s/%s to running" % (
                         instance.formation, instance.name))
-                try:
-                    instance.update(state=instance.STATE_RUNNING)
-                except DispatchError:
-                    print "ERROR"
+                instance.update(state=instance.STATE_RUNNING)
+
+    def _postpone(self, instances):
+        """Check C{instances} again in a little while."""
+        for instance in instances:
+            self._dirty.setdefault((instance.formation, instance.name),
+                                   instance)
+        self._runner.retry(_RETRY)
 
 
 class Terminator(object):
     """Process responsible for moving instances from "shutting down"
     into "terminated" by killing them off.
     """
+    log = logging.getLogger('scheduler.terminator')
 
     def __init__(self, clock, store_query, manager):
-        self._runner = RecurringTask(3, self._do_terminate)
+        self._runner = RecurringTask(_INTERVAL, self._do_terminate,
+                                     _DEBOUNCE)
         self.store_query = store_query
         self.manager = manager
         self._limiter = TokenBucketRateLimiter(clock, 10, 30)
         self.start = self._runner.start
         self.stop = self._runner.stop
+        self.store_query.on('create', self._handle_change)
+        self.store_query.on('update', self._handle_change)
+
+    def _handle_change(self, instance):
+        if instance.state == instance.STATE_SHUTTING_DOWN:
+            self._runner.touch()
 
     def _do_terminate(self):
+        batches = {}
         for instance in self.store_query.shutting_down():
             if not self._limiter.check():
+                self._runner.retry(_RETRY)
                 break
-            try:
-                instance.terminate(self.manager)
-            except DispatchError:
-                print "ERROR"
+            if instance.assigned_to:
+                batches.setdefault(instance.assigned_to, []).append(instance)
+            else:
+                # never made it to an executor; nothing to kill.
+                instance.set_state(instance.STATE_TERMINATED)
+        gevent.joinall([gevent.spawn(self._terminate, name, instances)
+                        for name, instances in batches.iteritems()])
+
+    def _terminate(self, name, instances):
+        try:
+            errors = self.manager.terminate_many(instances, name)
+        except DispatchError, err:
+            errors = [err] * len(instances)
+        for instance, err in zip(instances, errors):
+            if err is None:
+                instance.set_state(instance.STATE_TERMINATED)
+            else:
+                self.log.error("could not terminate %s/%s on %s: %s" % (
+                        instance.formation, instance.name, name, err))
+                self._runner.retry(_RETRY)
@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
+from itertools import chain
 from operator import attrgetter
 
 from gevent.event import Event
@@ -23,7 +25,7 @@ import shortuuid
 
 def create(store_command, formation, service, release,
            image, command, env=None, ports=None,
-           assigned_to=None, placement=None):
+           assigned_to=None, placement=None, resources=None):
     instance = shortuuid.uuid()
     return store_command.create(
             formation=formation,
@@ -37,16 +39,30 @@ def create(store_command, formation, service, release,
             image=image,
             command=command,
             env=env,
-            ports=ports)
+            ports=ports,
+            resources=resources)
+
+
+def spec_fingerprint(image, command, env, ports):
+    """Return a stable hash of the runtime spec of a container."""
+    spec = [image, command, env or {}, ports or []]
+    return hashlib.sha1(json.dumps(spec, sort_keys=True,
+                                   separators=(',', ':'))).hexdigest()
 
 
 class Instance(object):
-    """Information about an instance."""
+    """Information about an instance.
+
+    C{fingerprint} is the L{spec_fingerprint} of the instance.  It is
+    kept up to date as the spec changes.
+    """
 
     __attributes__ = (
         'name', 'instance', 'service', 'formation', 'placement',
         'state', 'assigned_to', 'image', 'command', 'env',
-        'release', 'ports')
+        'release', 'ports', 'resources', 'fingerprint')
+
+    SPEC_ATTRIBUTES = ('image', 'command', 'env', 'ports')
 
     STATE_PENDING_ASSIGNMENT = 'pending-assignment'
     STATE_PENDING_DISPATCH = 'pending-dispatch'
@@ -79,10 +95,11 @@ class Instance(object):
     def rerelease(self, release):
         self.update(release=release)
 
-    def migrate(self, release, image, command, env, ports):
+    def migrate(self, release, image, command, env, ports,
+                resources=None, state=STATE_MIGRATING):
         self.update(release=release, image=image,
                     command=command, env=env, ports=ports,
-                    state=self.STATE_MIGRATING)
+                    resources=resources, state=state)
 
     def shutdown(self):
         self.update(state=self.STATE_SHUTTING_DOWN)
@@ -107,6 +124,10 @@ class Instance(object):
         for attr in self.__attributes__:
             if attr in kwargs:
                 setattr(self, attr, kwargs[attr])
+        if 'fingerprint' not in kwargs and any(
+                attr in kwargs for attr in self.SPEC_ATTRIBUTES):
+            self.fingerprint = spec_fingerprint(
+                self.image, self.command, self.env, self.ports)
 
     def __repr__(self):
         return '<Instance name=%s release=%s>' % (
@@ -128,10 +149,16 @@ class _InstanceStoreCommon(object):
         return form_name, name
 
 
-class InstanceStoreCommand(_InstanceStoreCommon):
-    """Interface against the instance store that allows commands."""
+class InstanceStoreCommand(pyee.EventEmitter, _InstanceStoreCommon):
+    """Interface against the instance store that allows commands.
+
+    Emits an C{update} event whenever an instance is about to be
+    written, so that a query interface holding the same instance can
+    keep its indexes up to date with local modifications.
+    """
 
     def __init__(self, client):
+        pyee.EventEmitter.__init__(self)
         self.client = client
 
     def create(self, **kwargs):
@@ -145,17 +172,59 @@ class InstanceStoreCommand(_InstanceStoreCommon):
 
     def update(self, instance):
         """Update instance."""
+        self.emit('update', instance)
         self.client.set(self._make_key(instance), json.dumps(instance.to_json()))
 
 
+class _Index(object):
+    """Secondary index that maps a key to the set of instances with
+    that key.
+    """
+
+    def __init__(self, keyfn):
+        self.keyfn = keyfn
+        self._buckets = {}
+
+    def add(self, key, inst):
+        self._buckets.setdefault(key, set()).add(inst)
+
+    def remove(self, key, inst):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.discard(inst)
+            if not bucket:
+                del self._buckets[key]
+
+    def get(self, key):
+        return self._buckets.get(key, ())
+
+    def clear(self):
+        self._buckets.clear()
+
+
 class InstanceStoreQuery(pyee.EventEmitter,_InstanceStoreCommon):
-    """Interface against the instance store that allows querying."""
+    """Interface against the instance store that allows querying.
+
+    Besides the primary C{(formation, name)} mapping, instances are
+    indexed by state, formation, release, service and the executor
+    they are assigned to, so that queries cost time proportional to
+    the size of the result rather than the size of the store.
+    """
 
     def __init__(self, client, store_command):
         pyee.EventEmitter.__init__(self)
         self.client = client
         self.store_command = store_command
+        self.store_command.on('update', self._local_update)
         self._store = {}
+        self._indexes = {
+            'state': _Index(attrgetter('state')),
+            'formation': _Index(attrgetter('formation')),
+            'release': _Index(attrgetter('formation', 'release')),
+            'service': _Index(attrgetter('formation', 'service')),
+            'assigned_to': _Index(attrgetter('assigned_to')),
+            }
+        self._keys = {}
         self._watcher = None
         self._stopped = Event()
         self._get = lambda f, n: self._store.get((f, n))
@@ -167,6 +236,9 @@ class InstanceStoreQuery(pyee.EventEmitter,_InstanceStoreCommon):
         """Start the instance store by reading all state into memory.
         """
         self._store.clear()
+        self._keys.clear()
+        for index in self._indexes.itervalues():
+            index.clear()
         self._get_all_instances()
         self._start_watching()
 
@@ -188,6 +260,7 @@ class InstanceStoreQuery(pyee.EventEmitter,_InstanceStoreCommon):
             value = json.loads(event.value)
             if value == instance.to_json():
                 # ignore the event if there wasn't any change.
+                self._reindex(instance)
                 return
             self._update(instance, value)
         else:
@@ -213,40 +286,83 @@ class InstanceStoreQuery(pyee.EventEmitter,_InstanceStoreCommon):
             methodname = '_handle_event_%s' % (event.action,)
             getattr(self, methodname)(event)
 
+    def _lookup(self, index, *keys):
+        return list(chain.from_iterable(
+                self._indexes[index].get(key) for key in keys))
+
     def unassigned(self):
         """Return an iterator that yields unassigned instances.
         """
-        return (inst for inst in self._store.itervalues()
-                if inst.state == Instance.STATE_PENDING
-                or inst.state == None)
+        return iter(self._lookup('state', Instance.STATE_PENDING, None))
 
     def shutting_down(self):
         """All instances with state 'terminating'"""
-        return (inst for inst in self._store.itervalues()
-                if inst.state == inst.STATE_SHUTTING_DOWN)
+        return iter(self._lookup('state', Instance.STATE_SHUTTING_DOWN))
 
     def terminated(self):
-        return (inst for inst in self._store.itervalues()
-                if inst.state == inst.STATE_TERMINATED)
-    
+        return iter(self._lookup('state', Instance.STATE_TERMINATED))
+
     def running(self):
-        return (inst for inst in self._store.itervalues()
-                if inst.state == Instance.STATE_RUNNING)
+        return iter(self._lookup('state', Instance.STATE_RUNNING))
+
+    def _index(self, inst):
+        keys = {}
+        for name, index in self._indexes.iteritems():
+            keys[name] = key = index.keyfn(inst)
+            index.add(key, inst)
+        self._keys[(inst.formation, inst.name)] = keys
+
+    def _unindex(self, inst):
+        keys = self._keys.pop((inst.formation, inst.name), {})
+        for name, key in keys.iteritems():
+            self._indexes[name].remove(key, inst)
+
+    def _reindex(self, inst):
+        """Move the instance to the right index buckets, if it is
+        one that we know about and any of the indexed attributes
+        changed.
+        """
+        keys = self._keys.get((inst.formation, inst.name))
+        if keys is None or self._get(inst.formation, inst.name) is not inst:
+            return
+        for name, index in self._indexes.iteritems():
+            key = index.keyfn(inst)
+            if key != keys[name]:
+                index.remove(keys[name], inst)
+                index.add(key, inst)
+                keys[name] = key
+
+    def _local_update(self, inst):
+        """Handle an update that was made in this process.
+
+        The watch ignores the echo of such an update since the
+        instance already holds the new values, so this is where the
+        indexes are updated and the change is announced.
+        """
+        if self._get(inst.formation, inst.name) is inst:
+            self._reindex(inst)
+            self.emit('update', inst)
 
     def _create(self, value):
         inst = Instance(self.store_command, **value)
-        self._store[(inst.formation, inst.name)] = inst
+        key = (inst.formation, inst.name)
+        if key in self._store:
+            self._unindex(self._store[key])
+        self._store[key] = inst
+        self._index(inst)
         self.emit('create', inst)
         return inst
 
     def _update(self, instance, values):
         """Update the given instance with new values."""
         instance._update(values)
+        self._reindex(instance)
         self.emit('update', instance)
 
     def _delete(self, instance):
         """Delete the given instance."""
         del self._store[(instance.formation, instance.name)]
+        self._unindex(instance)
         self.emit('delete', instance)
 
     def index(self):
@@ -255,7 +371,18 @@ class InstanceStoreQuery(pyee.EventEmitter,_InstanceStoreCommon):
 
     def query_formation(self, formation):
         """Return instances for formation."""
-        insts = [inst for inst in self.index()
-                 if inst.formation == formation]
+        insts = self._lookup('formation', formation)
         insts.sort(key=attrgetter('name'))
         return insts
+
+    def query_release(self, formation, release):
+        """Return instances of a specific release of a formation."""
+        return self._lookup('release', (formation, release))
+
+    def query_service(self, formation, service):
+        """Return instances of a service in a formation."""
+        return self._lookup('service', (formation, service))
+
+    def query_assigned(self, name):
+        """Return instances assigned to the executor C{name}."""
+        return self._lookup('assigned_to', name)
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict, deque
 import logging
 import time
 
@@ -25,6 +26,33 @@ def first(it, default):
     return next(iter(it), default)
 
 
+class LRUCache(object):
+    """Mapping that holds on to at most C{maxsize} entries, evicting
+    the least recently used one when full.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class TokenBucketRateLimiter(object):
 
     def __init__(self, clock, rate, time):
@@ -38,7 +66,7 @@ class TokenBucketRateLimiter(object):
         current = self.clock.time()
         time_passed = current - self._last_check
         self._last_check = current
-        self._allowance += (time_passed * (self.rate / self.time))
+        self._allowance += (time_passed * (self.rate / float(self.time)))
         if self._allowance > self.rate:
             self._allowance = self.rate
         if self._allowance < 1.0:
@@ -48,31 +76,194 @@ class TokenBucketRateLimiter(object):
             return True
 
 
+class CircuitBreaker(object):
+    """Circuit breaker that also scores the health of what it guards.
+
+    The outcome and latency of every call is recorded in a rolling
+    window of WINDOW seconds.  The circuit opens after MAX_FAILURES
+    failures in a row, or when at least MIN_CALLS calls in the window
+    have an error rate of ERROR_RATE or more.  An open circuit lets
+    no calls through until RESET_TIMEOUT seconds have passed, after
+    which it is half-open and lets a single probe through.  A
+    successful probe closes the circuit and a failed one opens it
+    again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    WINDOW = 60
+    MAX_SAMPLES = 200
+    MIN_CALLS = 10
+    ERROR_RATE = 0.5
+    MAX_FAILURES = 3
+    RESET_TIMEOUT = 10
+
+    # calls with a p95 latency above SLOW seconds lower the health
+    # score.  the score is recomputed at most every SCORE_TTL seconds.
+    SLOW = 2.0
+    SCORE_TTL = 1
+
+    def __init__(self, clock, log=None):
+        self.clock = clock
+        self.log = log or logging.getLogger('util.breaker')
+        self.state = self.CLOSED
+        self._samples = deque(maxlen=self.MAX_SAMPLES)
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._score = None
+        self._scored_at = None
+
+    def allow(self):
+        """Return true if a call may be made now."""
+        self._expire()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def available(self):
+        """Return true unless the circuit is open."""
+        self._expire()
+        return self.state != self.OPEN
+
+    def record(self, ok, latency):
+        """Record the outcome of a call that took C{latency} seconds."""
+        self._expire()
+        self._samples.append((self.clock.time(), ok, latency))
+        if ok:
+            self._failures = 0
+            if self.state == self.HALF_OPEN:
+                self._transition(self.CLOSED)
+            return
+        self._failures += 1
+        if self.state == self.HALF_OPEN:
+            self.trip()
+        elif self.state == self.CLOSED and (
+                self._failures >= self.MAX_FAILURES
+                or self._error_rate() >= self.ERROR_RATE):
+            self.trip()
+
+    def trip(self):
+        """Open the circuit."""
+        self._opened_at = self.clock.time()
+        self._transition(self.OPEN)
+
+    def health(self):
+        """Return a score between 0.0 and 1.0 where 1.0 is a healthy
+        target without errors or slow calls, and 0.0 is an open
+        circuit.
+        """
+        self._expire()
+        if self.state == self.OPEN:
+            return 0.0
+        now = self.clock.time()
+        if self._score is None or now - self._scored_at > self.SCORE_TTL:
+            self._score, self._scored_at = self._compute_score(), now
+        if self.state == self.HALF_OPEN:
+            return self._score / 2
+        return self._score
+
+    def p95(self):
+        """Return the 95th percentile latency of the calls in the
+        window, or C{None} if there are none.
+        """
+        self._prune()
+        if not self._samples:
+            return None
+        latencies = sorted(latency for (_, _, latency) in self._samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def _compute_score(self):
+        self._prune()
+        if not self._samples:
+            return 1.0
+        errors = sum(1 for (_, ok, _) in self._samples if not ok)
+        score = 1.0 - float(errors) / len(self._samples)
+        p95 = self.p95()
+        if p95 > self.SLOW:
+            score *= self.SLOW / p95
+        return score
+
+    def _error_rate(self):
+        self._prune()
+        if len(self._samples) < self.MIN_CALLS:
+            return 0.0
+        errors = sum(1 for (_, ok, _) in self._samples if not ok)
+        return float(errors) / len(self._samples)
+
+    def _prune(self):
+        horizon = self.clock.time() - self.WINDOW
+        while self._samples and self._samples[0][0] < horizon:
+            self._samples.popleft()
+
+    def _expire(self):
+        if (self.state == self.OPEN
+                and self.clock.time() - self._opened_at
+                >= self.RESET_TIMEOUT):
+            self._transition(self.HALF_OPEN)
+
+    def _transition(self, state):
+        if state != self.state:
+            self.log.info("circuit %s" % (state,))
+        self.state = state
+        self._probing = False
+
+
 class RecurringTask(object):
+    """Run C{fn} every C{interval} seconds, or sooner when touched.
+
+    A burst of touches is collapsed into a single run by waiting
+    C{debounce} seconds after the first one before running.
+    """
 
-    def __init__(self, interval, fn):
+    def __init__(self, interval, fn, debounce=0):
         self.interval = interval
         self.fn = fn
+        self.debounce = debounce
         self._wakeup = Event()
         self._stopped = Event()
         self._gthread = None
+        self._retry = None
 
     def touch(self):
         """Make sure the task is executed now."""
         self._wakeup.set()
-    
-    def start(self):
-        self._gthread = gevent.spawn(self._run)
+
+    def retry(self, delay):
+        """Make sure the task is executed again within C{delay}
+        seconds.  Meant to be called by C{fn} when it could not
+        finish all its work.
+        """
+        if self._retry is None or delay < self._retry:
+            self._retry = delay
+
+    def start(self, now=True):
+        """Start running the task, right away or, if C{now} is false,
+        after the first interval.
+        """
+        self._gthread = gevent.spawn(self._run, now)
 
     def stop(self):
         self._stopped.set()
         self._wakeup.set()
 
-    def _run(self):
+    def _run(self, now):
+        if not now:
+            self._wait(self.interval)
         while not self._stopped.is_set():
+            self._retry = None
             self.fn()
-            self._wakeup.wait(timeout=self.interval)
-            self._wakeup.clear()
+            self._wait(self._retry if self._retry is not None
+                       else self.interval)
+
+    def _wait(self, timeout):
+        if self._wakeup.wait(timeout=timeout) and self.debounce:
+            self._stopped.wait(self.debounce)
+        self._wakeup.clear()
 
 
 class Lock(object):
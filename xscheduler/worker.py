@@ -15,6 +15,7 @@
 from gevent import monkey
 monkey.patch_all()
 
+from functools import partial
 import os
 import time
 import logging
@@ -23,8 +24,11 @@ import etcd
 from gilliam.service_registry import (ServiceRegistryClient, Resolver)
 
 from xscheduler.scheduler import (RequirementRankPlacementPolicy,
+                                  BinPackPlacementPolicy,
                                   Scheduler, Updater, Terminator)
 from xscheduler.executor import ExecutorManager
+from xscheduler.migration import MigrationStore, Migrator
+from xscheduler.release import Release, ReleaseStore
 from xscheduler import store, util
 
 from .cache import make_client as make_cache_client
@@ -45,6 +49,7 @@ def main():
     formation = os.getenv('GILLIAM_FORMATION')
     instance = os.getenv('GILLIAM_INSTANCE')
     check_interval = int(os.getenv('CHECK_INTERVAL', 10))
+    stream_events = bool(os.getenv('STREAM_EVENTS'))
     
     store_client = etcd.Etcd(host='_store.%s.service' % (formation,))
     store_command = store.InstanceStoreCommand(store_client)
@@ -53,16 +58,30 @@ def main():
     registry_client = ServiceRegistryClient(time)
     registry_resolver = Resolver(registry_client)
     state_cache = make_cache_client(registry_resolver,
-                                    '_cache.{0}.service'.format(formation))
+                                    '_cache.{0}.service'.format(formation),
+                                    write_behind=True)
 
     executor_manager = ExecutorManager(time, registry_client, store_query,
-                                       state_cache, check_interval)
-
-    policy = RequirementRankPlacementPolicy()
+                                       state_cache, check_interval,
+                                       stream=stream_events)
+
+    placement = os.getenv('PLACEMENT_POLICY', 'rank')
+    if placement == 'rank':
+        policy = RequirementRankPlacementPolicy()
+    elif placement in (BinPackPlacementPolicy.BEST_FIT,
+                       BinPackPlacementPolicy.WORST_FIT):
+        policy = BinPackPlacementPolicy(placement)
+    else:
+        raise SystemExit("PLACEMENT_POLICY must be rank, %s or %s, not %r" % (
+                BinPackPlacementPolicy.BEST_FIT,
+                BinPackPlacementPolicy.WORST_FIT, placement))
     services = [
         Scheduler(time, store_query, executor_manager, policy),
         Updater(time, store_query, executor_manager),
-        Terminator(time, store_query, executor_manager)
+        Terminator(time, store_query, executor_manager),
+        Migrator(time, store_query, state_cache, ReleaseStore(store_client),
+                 MigrationStore(store_client),
+                 partial(Release, store_command, store_query))
         ]
 
     leader_lock = util.Lock(store_client, 'leader', instance)